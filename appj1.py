@@ -2,11 +2,15 @@
 # responde 202 y envia en background
 # sin tildes ni letra n
 
-import os, json, time, threading, pymysql, requests, base64
+import os, re, sys, json, time, uuid, queue, atexit, random, asyncio, hashlib, logging, sqlite3, threading, multiprocessing, pymysql, httpx, base64
 from datetime import datetime, timedelta
 from threading import Thread
-from flask import Flask, jsonify, render_template
-from email.mime.multipart import MIMEMultipart  # solo para mantener tu render_template; no se usa para enviar
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import NamedTuple
+from flask import Flask, jsonify, request
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 
 from db_config import DB_CONFIG
 
@@ -26,45 +30,485 @@ missing = [k for k,v in {
 if missing:
     raise RuntimeError(f"Faltan variables: {', '.join(missing)}")
 
+# --------- log estructurado ---------
+LOG_LEVEL = os.getenv("APPJ1_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("APPJ1_LOG_FORMAT", "json")  # json (una linea JSON por evento) | texto
+LOG_FILE = os.getenv("APPJ1_LOG_FILE", "")  # vacio: stdout
+LOG_MAX_BYTES = int(os.getenv("APPJ1_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("APPJ1_LOG_BACKUPS", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("APPJ1_LOG_QUEUE_SIZE", "10000"))
+LOG_FLUSH_SECONDS = float(os.getenv("APPJ1_LOG_FLUSH_SECONDS", "0.5"))
+LOG_BATCH = 500  # lineas como maximo por escritura
+LOG_CHECK_SECONDS = 1.0  # cada cuanto se mira si otro proceso roto el fichero
+LOG_ROTATE_RETRY_SECONDS = 60.0  # espera tras una rotacion fallida (Windows con el fichero abierto por otro)
+
+def bloquear_fichero(fh) -> bool:
+    """Lock exclusivo no bloqueante entre procesos (flock en posix, msvcrt en Windows/IIS)."""
+    try:
+        if os.name == "nt":
+            import msvcrt
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def desbloquear_fichero(fh) -> None:
+    try:
+        if os.name == "nt":
+            import msvcrt
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    except OSError:
+        pass
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        evento = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "job", None):
+            evento["job"] = record.job
+        evento.update(getattr(record, "campos", {}))
+        if record.exc_info:
+            evento["exc"] = self.formatException(record.exc_info)
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+class TextoFormatter(logging.Formatter):
+    # el formato de siempre, para leer a mano en desarrollo
+    def format(self, record: logging.LogRecord) -> str:
+        campos = " ".join(f"{k}={v}" for k, v in getattr(record, "campos", {}).items())
+        return f"[APPJ1] {datetime.fromtimestamp(record.created).isoformat(timespec='seconds')} | {record.getMessage()}" + (f" | {campos}" if campos else "")
+
+class LogEscritor:
+    """Hilo unico que vacia la cola de log a stdout o a fichero.
+
+    Escribe por lotes (un write y un flush por lote, no por linea) y rota el
+    fichero por tamano como RotatingFileHandler (app.log, app.log.1, ...).
+    Varios procesos (workers de wfastcgi, shards) pueden compartir el fichero:
+    solo rota quien tiene el lock app.log.lock, y los demas se reabren al ver
+    que el fichero cambio (hasta LOG_CHECK_SECONDS despues, asi que un fichero
+    rotado puede pasar algo del limite). Si la rotacion falla (en Windows, otro proceso
+    con el fichero abierto) se sigue escribiendo y se reintenta mas tarde.
+    """
+
+    def __init__(self, path: str = LOG_FILE, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS,
+                 flush_seconds: float = LOG_FLUSH_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_seconds = flush_seconds
+        self.cola = queue.Queue(LOG_QUEUE_SIZE)
+        self.formatter = JsonFormatter() if LOG_FORMAT == "json" else TextoFormatter()
+        self._stream = None
+        self._tamano = 0
+        self._revisado = 0.0
+        self._rotar_desde = 0.0
+        self._hilo = None
+
+    def start(self) -> None:
+        if self._hilo is None:
+            self._hilo = Thread(target=self._loop, name="appj1_log", daemon=True)
+            self._hilo.start()
+
+    def stop(self) -> None:
+        if self._hilo is not None:
+            self.cola.put(None)
+            self._hilo.join(timeout=5)
+            self._hilo = None
+
+    def _abrir(self):
+        if not self.path:
+            return sys.stdout
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        stream = open(self.path, "a", encoding="utf-8")
+        self._tamano = stream.tell()
+        return stream
+
+    def _reabrir(self) -> None:
+        stream, self._stream = self._stream, None
+        try:
+            stream.close()
+        except Exception:
+            pass
+        # si falla la apertura _stream queda en None y el siguiente lote lo intenta de nuevo
+        self._stream = self._abrir()
+
+    def _revisar(self) -> None:
+        # otro proceso pudo rotar el fichero: se reabre, y se toma el tamano real (escriben varios)
+        ahora = time.monotonic()
+        if ahora - self._revisado < LOG_CHECK_SECONDS:
+            return
+        self._revisado = ahora
+        try:
+            disco = os.stat(self.path)
+            propio = os.fstat(self._stream.fileno())
+        except OSError:
+            disco = propio = None
+        if disco is None or (disco.st_ino, disco.st_dev) != (propio.st_ino, propio.st_dev):
+            self._reabrir()
+        else:
+            self._tamano = disco.st_size
+
+    def _rotar(self) -> None:
+        try:
+            with open(self.path + ".lock", "a+") as candado:
+                if not bloquear_fichero(candado):
+                    # otro proceso esta rotando: al terminar se vera el fichero nuevo
+                    self._rotar_desde = time.monotonic() + LOG_CHECK_SECONDS
+                    return
+                try:
+                    # puede que otro proceso acabe de rotar: entonces no hay nada que hacer
+                    if os.path.getsize(self.path) >= self.max_bytes:
+                        self._stream.close()  # en Windows no se renombra un fichero abierto
+                        for i in range(self.backups - 1, 0, -1):
+                            origen = f"{self.path}.{i}"
+                            if os.path.exists(origen):
+                                os.replace(origen, f"{self.path}.{i + 1}")
+                        if self.backups > 0:
+                            os.replace(self.path, f"{self.path}.1")
+                        else:
+                            os.remove(self.path)
+                finally:
+                    desbloquear_fichero(candado)
+        except OSError as e:
+            self._rotar_desde = time.monotonic() + LOG_ROTATE_RETRY_SECONDS
+            print(f"[APPJ1] no se pudo rotar {self.path}: {e}", file=sys.stderr, flush=True)
+        self._reabrir()
+
+    def _escribir(self, registros: list) -> None:
+        if self._stream is None:
+            self._stream = self._abrir()
+        elif self.path:
+            self._revisar()
+        trozo = []
+        tamano_trozo = 0
+        for r in registros:
+            try:
+                linea = self.formatter.format(r) + "\n"
+            except Exception as e:
+                linea = json.dumps({"level": "error", "msg": f"log no formateable: {e}"}) + "\n"
+            n = len(linea.encode("utf-8"))
+            if self.path and self.max_bytes and self._tamano + tamano_trozo + n > self.max_bytes \
+                    and self._tamano + tamano_trozo > 0 and time.monotonic() >= self._rotar_desde:
+                self._stream.write("".join(trozo))
+                self._rotar()
+                trozo, tamano_trozo = [], 0
+            trozo.append(linea)
+            tamano_trozo += n
+        self._stream.write("".join(trozo))
+        self._stream.flush()
+        self._tamano += tamano_trozo
+
+    def _loop(self) -> None:
+        fin = False
+        while not fin:
+            try:
+                primero = self.cola.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                continue
+            lote = [primero]
+            while len(lote) < LOG_BATCH:
+                try:
+                    lote.append(self.cola.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lote:
+                fin = True
+                lote = [r for r in lote if r is not None]
+            try:
+                self._escribir(lote)
+            except Exception as e:
+                print(f"[APPJ1] error escribiendo log: {e}", file=sys.stderr, flush=True)
+
+class ColaHandler(logging.Handler):
+    """Handler no bloqueante: solo encola; si la cola esta llena descarta y lo cuenta."""
+
+    def __init__(self, escritor: LogEscritor):
+        super().__init__()
+        self.escritor = escritor
+        self.descartados = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.escritor.cola.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+log_escritor = LogEscritor()
+logger = logging.getLogger("appj1")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+logger.addHandler(ColaHandler(log_escritor))
+log_escritor.start()
+atexit.register(log_escritor.stop)
+
+def log(msg: str, level: str = "info", **campos):
+    # campos: datos estructurados del evento (destino, filas, duracion_ms, ...)
+    logger.log(logging.getLevelName(level.upper()), msg, extra={"campos": campos} if campos else None)
+
 # --------- utils ---------
-def log(msg: str):
-    print(f"[APPJ1] {datetime.now().isoformat(timespec='seconds')} | {msg}", flush=True)
 
 def load_email_config(path: str = "config.json") -> dict:
     try:
         with open(path, "r", encoding="utf-8") as f:
             data = json.loads(f.read())
     except Exception as e:
-        log(f"error cargando config.json: {e}")
+        log(f"error cargando config.json: {e}", "error")
         data = {}
-    return {"cc": data.get("cc", []), "cco": data.get("cco", [])}
+    return {
+        "cc": data.get("cc", []),
+        "cco": data.get("cco", []),
+        # true: los conductores reciben el correo sin cc/cco y los responsables un unico resumen al final
+        "cc_resumen": bool(data.get("cc_resumen", False)),
+    }
+
+# --------- metricas (formato texto de Prometheus) ---------
+LATENCIA_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _etiquetas(nombres: tuple, valores: tuple) -> str:
+    if not nombres:
+        return ""
+    pares = []
+    for k, v in zip(nombres, valores):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{k}="{v}"')
+    return "{" + ",".join(pares) + "}"
+
+class Contador:
+    """Contador monotono con etiquetas; inc() es un dict y un lock."""
+
+    tipo = "counter"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._lock = threading.Lock()
+        self._valores = {}
+
+    def inc(self, n: float = 1, **etiquetas) -> None:
+        clave = tuple(str(etiquetas.get(k, "")) for k in self.etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + n
+
+    def muestras(self) -> list:
+        with self._lock:
+            return [f"{self.nombre}{_etiquetas(self.etiquetas, k)} {v}" for k, v in sorted(self._valores.items())]
+
+class Histograma:
+    """Histograma con buckets fijos; observe() es O(buckets) bajo un lock."""
+
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = LATENCIA_BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # etiquetas -> [cuentas por bucket, suma, total]
+
+    def observe(self, valor: float, **etiquetas) -> None:
+        clave = tuple(str(etiquetas.get(k, "")) for k in self.etiquetas)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * len(self.buckets), 0.0, 0]
+            for i, tope in enumerate(self.buckets):
+                if valor <= tope:
+                    serie[0][i] += 1
+                    break
+            serie[1] += valor
+            serie[2] += 1
+
+    @contextmanager
+    def time(self, **etiquetas):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **etiquetas)
+
+    def muestras(self) -> list:
+        lineas = []
+        with self._lock:
+            for clave, (cuentas, suma, total) in sorted(self._series.items()):
+                acumulado = 0
+                for tope, n in zip(self.buckets, cuentas):
+                    acumulado += n
+                    lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas + ('le',), clave + (tope,))} {acumulado}")
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas + ('le',), clave + ('+Inf',))} {total}")
+                lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {suma}")
+                lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {total}")
+        return lineas
+
+class Metricas:
+    def __init__(self):
+        self._metricas = []
+
+    def contador(self, nombre: str, ayuda: str, etiquetas: tuple = ()) -> Contador:
+        m = Contador(nombre, ayuda, etiquetas)
+        self._metricas.append(m)
+        return m
+
+    def histograma(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = LATENCIA_BUCKETS) -> Histograma:
+        m = Histograma(nombre, ayuda, etiquetas, buckets)
+        self._metricas.append(m)
+        return m
+
+    def exposicion(self) -> str:
+        lineas = []
+        for m in self._metricas:
+            lineas.append(f"# HELP {m.nombre} {m.ayuda}")
+            lineas.append(f"# TYPE {m.nombre} {m.tipo}")
+            lineas.extend(m.muestras())
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+M_DB_SEGUNDOS = metricas.histograma("appj1_db_query_seconds", "Tiempo de la consulta ITV", ("origen",))
+M_DB_FILAS = metricas.contador("appj1_db_rows_total", "Filas devueltas por la consulta ITV", ("origen",))
+M_DB_ERRORES = metricas.contador("appj1_db_errors_total", "Errores de la consulta ITV", ("origen",))
+M_RENDER_SEGUNDOS = metricas.histograma("appj1_render_seconds", "Tiempo de render de plantillas", ("plantilla",))
+M_GRAPH_SEGUNDOS = metricas.histograma("appj1_graph_request_seconds", "Latencia de peticiones a Graph y login", ("endpoint", "status"))
+M_GRAPH_REINTENTOS = metricas.contador("appj1_graph_retries_total", "Reintentos contra Graph por motivo", ("endpoint", "motivo"))
+M_TOKEN_RENOVACIONES = metricas.contador("appj1_token_refreshes_total", "Tokens pedidos al endpoint de login")
+
+def _endpoint(url: str) -> str:
+    # etiqueta de baja cardinalidad: nunca el buzon ni el tenant
+    if url.endswith("/token"):
+        return "token"
+    if url.endswith("/$batch"):
+        return "batch"
+    if url.endswith("/sendMail"):
+        return "sendMail"
+    return "otro"
 
-def weekday_today() -> int:
-    return datetime.now().weekday()  # 0 lunes .. 6 domingo
+# --------- politica de envio ---------
+VENTANA_DIAS = 32  # solo se consultan vehiculos con ITV en los proximos 32 dias (o vencida)
+# regla por defecto; se sobreescribe con la clave "politica" de config.json
+POLITICA_DEFECTO = {
+    "umbrales": [31, 25, 20, 15],  # avisos puntuales (dias restantes)
+    "aviso_diario_menor_que": 13,  # por debajo se avisa todos los dias (null: sin aviso diario)
+    "dias_sin_envio": [6],  # 0 lunes .. 6 domingo
+    "festivos": [],  # "AAAA-MM-DD"
+    "recuperar": True,  # el primer dia con envio recupera los umbrales de los dias sin envio anteriores
+}
+RECUPERAR_MAX_DIAS = 7
 
-def weekday_yesterday() -> int:
-    return (datetime.now() - timedelta(days=1)).weekday()
+class PoliticaDia(NamedTuple):
+    """Politica compilada para un dia: (valores exactos, aviso diario por debajo de)."""
+    dias: frozenset
+    menor_que: int | None
+
+class ReglaEnvio:
+    """Regla declarativa de config.json compilada a PoliticaDia por fecha.
+
+    Dias sin envio: los de dias_sin_envio y los festivos. Con recuperar, el
+    primer dia con envio suma los umbrales desplazados por los dias saltados
+    justo antes (lunes tras domingo: 30, 24, 19, 14).
+    """
+
+    def __init__(self, regla: dict | None = None):
+        r = {**POLITICA_DEFECTO, **(regla or {})}
+        self.menor_que = None if r["aviso_diario_menor_que"] is None else int(r["aviso_diario_menor_que"])
+        self.umbrales = tuple(sorted({int(d) for d in r["umbrales"]}, reverse=True))
+        fuera = [d for d in self.umbrales if not 0 <= d < VENTANA_DIAS]
+        if fuera:
+            log(f"politica: umbrales fuera de la ventana de {VENTANA_DIAS} dias ignorados: {fuera}", "warning")
+            self.umbrales = tuple(d for d in self.umbrales if 0 <= d < VENTANA_DIAS)
+        self.dias_sin_envio = frozenset(int(d) for d in r["dias_sin_envio"])
+        self.festivos = frozenset(datetime.strptime(f, "%Y-%m-%d").date() for f in r["festivos"])
+        self.recuperar = bool(r["recuperar"])
+        self._compiladas = {}
+
+    def envia(self, fecha) -> bool:
+        return fecha.weekday() not in self.dias_sin_envio and fecha not in self.festivos
+
+    def compilar(self, fecha) -> PoliticaDia:
+        politica = self._compiladas.get(fecha)
+        if politica is not None:
+            return politica
+        if not self.envia(fecha):
+            politica = PoliticaDia(frozenset(), None)
+        else:
+            dias = set(self.umbrales)
+            saltados = 0
+            while self.recuperar and saltados < RECUPERAR_MAX_DIAS and not self.envia(fecha - timedelta(days=saltados + 1)):
+                saltados += 1
+                dias |= {d - saltados for d in self.umbrales}
+            # lo que ya cubre el aviso diario no hace falta como valor exacto
+            minimo = self.menor_que if self.menor_que is not None else 0
+            politica = PoliticaDia(frozenset(d for d in dias if d >= minimo), self.menor_que)
+        self._compiladas[fecha] = politica
+        return politica
+
+    def to_dict(self) -> dict:
+        return {
+            "umbrales": list(self.umbrales),
+            "aviso_diario_menor_que": self.menor_que,
+            "dias_sin_envio": sorted(self.dias_sin_envio),
+            "festivos": sorted(f.isoformat() for f in self.festivos),
+            "recuperar": self.recuperar,
+        }
+
+_reglas = {}  # (ruta, mtime) -> ReglaEnvio
+
+def regla_envio(path: str = "config.json") -> ReglaEnvio:
+    # se recompila solo si cambia config.json
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    regla = _reglas.get((path, mtime))
+    if regla is None:
+        datos = None
+        if mtime is not None:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    datos = json.loads(f.read()).get("politica")
+            except Exception as e:
+                log(f"error cargando la politica de config.json: {e}", "error")
+        try:
+            regla = ReglaEnvio(datos)
+        except Exception as e:
+            log(f"politica de config.json no valida, se usa la de por defecto: {e}", "error")
+            regla = ReglaEnvio()
+        _reglas.clear()
+        _reglas[(path, mtime)] = regla
+    return regla
+
+def politica_del_dia(fecha=None) -> PoliticaDia:
+    """Politica compilada para fecha (hoy por defecto)."""
+    return regla_envio().compilar(fecha or datetime.now().date())
+
+def debe_enviar(dias_restantes, politica: tuple) -> bool:
+    dias, menor_que = politica
+    if dias_restantes is None:
+        return False
+    return dias_restantes in dias or (menor_que is not None and dias_restantes < menor_que)
 
 # --------- DB ---------
-def get_data_from_db():
-    sql = """
-    SELECT 
-        vehiculo.name,
-        vehiculo.description,
-        vehiculo.tipo,
-        vehiculo.marca,
-        vehiculo.itv,
-        DATE_FORMAT(vehiculo.fecha_prxima_i_t_v, '%d/%m/%Y') AS fecha_prxima_i_t_v,
-        conductor.first_name,
-        conductor.last_name,
-        user.user_name,
-        user.first_name,
-        user.last_name,
-        user.title,
-        user.centro_de_trabajo,
-        email_address.name,
-        DATEDIFF(vehiculo.fecha_prxima_i_t_v, CURDATE()) AS dias_restantes
-    FROM comercialcrm.vehiculo
+DB_STREAM = os.getenv("APPJ1_DB_STREAM", "0") == "1"  # cursor de servidor: envia mientras lee
+
+class FilaITV(NamedTuple):
+    # columnas de la consulta ITV, en el orden del SELECT (solo lo que usan las plantillas y la politica)
+    matricula: str
+    fecha_prxima_i_t_v: str
+    first_name: str
+    centro_de_trabajo: str | None
+    email: str
+    dias_restantes: int
+
+ITV_FROM = """FROM comercialcrm.vehiculo
     INNER JOIN comercialcrm.vehiculo_conductor
         ON vehiculo.id = vehiculo_conductor.vehiculo_id
     INNER JOIN comercialcrm.conductor
@@ -76,54 +520,1268 @@ def get_data_from_db():
         AND entity_email_address.entity_type = 'User'
     INNER JOIN comercialcrm.email_address
         ON entity_email_address.email_address_id = email_address.id
-    WHERE 
-        (fecha_prxima_i_t_v < CURDATE() OR fecha_prxima_i_t_v < CURDATE() + INTERVAL 32 DAY)
+"""
+
+def itv_query(politica: tuple, fecha=None) -> tuple:
+    """SQL y parametros de la consulta ITV con la politica del dia en el WHERE.
+
+    fecha: dia de referencia (CURDATE() por defecto); sirve para el pronostico.
+    Devuelve (None, None) si ese dia no se envia nada.
+    """
+    dias, menor_que = politica
+    # con fecha se sustituye CURDATE() por un parametro: se repite en cada uso para mantener el orden
+    ref = "CURDATE()" if fecha is None else "%s"
+    ref_params = [] if fecha is None else [fecha.isoformat()]
+    condiciones, params = [], []
+    if menor_que is not None:
+        # equivalente a DATEDIFF(...) < menor_que pero usando el indice de la fecha
+        condiciones.append(f"vehiculo.fecha_prxima_i_t_v < {ref} + INTERVAL %s DAY")
+        params += ref_params + [menor_que]
+    if dias:
+        condiciones.append(
+            f"DATEDIFF(vehiculo.fecha_prxima_i_t_v, {ref}) IN (" + ", ".join(["%s"] * len(dias)) + ")"
+        )
+        params += ref_params + sorted(dias)
+    if not condiciones:
+        return None, None
+    # con parametros pymysql aplica %, por eso el formato de fecha va con %%
+    sql = f"""
+    SELECT 
+        vehiculo.name,
+        DATE_FORMAT(vehiculo.fecha_prxima_i_t_v, '%%d/%%m/%%Y') AS fecha_prxima_i_t_v,
+        conductor.first_name,
+        user.centro_de_trabajo,
+        email_address.name,
+        DATEDIFF(vehiculo.fecha_prxima_i_t_v, {ref}) AS dias_restantes
+    {ITV_FROM}    WHERE 
+        vehiculo.fecha_prxima_i_t_v < {ref} + INTERVAL %s DAY
         AND vehiculo.deleted = 0
         AND vehiculo_conductor.deleted = 0
+        AND ({" OR ".join(condiciones)})
+    """
+    return sql, ref_params + ref_params + [VENTANA_DIAS] + params
+
+def pronostico(fecha, filas: bool = False) -> dict:
+    """Que se enviaria en fecha: politica compilada y, con filas, los avisos.
+
+    Los avisos se calculan con los datos de hoy en la DB (sin cache ni
+    ledger): un cambio de fecha de ITV antes de ese dia cambia el resultado.
     """
-    conn = None
+    politica = politica_del_dia(fecha)
+    res = {
+        "fecha": fecha.isoformat(),
+        "envia": regla_envio().envia(fecha),
+        "dias": sorted(politica.dias, reverse=True),
+        "aviso_diario_menor_que": politica.menor_que,
+    }
+    if filas:
+        sql, params = itv_query(politica, fecha)
+        avisos = []
+        if sql is not None:
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, params)
+                avisos = [FilaITV._make(r)._asdict() for r in cur.fetchall()]
+        res["avisos"] = avisos
+    return res
+
+DB_POOL_SIZE = int(os.getenv("APPJ1_DB_POOL_SIZE", "4"))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("APPJ1_DB_POOL_IDLE_TIMEOUT", "300"))  # segundos
+DB_POOL_WAIT_TIMEOUT = float(os.getenv("APPJ1_DB_POOL_WAIT_TIMEOUT", "30"))
+
+def _db_connect():
+    return pymysql.connect(
+        host=DB_CONFIG["host"],
+        user=DB_CONFIG["user"],
+        password=DB_CONFIG["password"],
+        database=DB_CONFIG["database"],
+        port=DB_CONFIG["port"],
+        charset="utf8mb4",
+        cursorclass=pymysql.cursors.Cursor,
+        connect_timeout=10,
+        read_timeout=30,
+        write_timeout=30,
+        # sin autocommit una conexion reutilizada seguiria viendo la foto de su primera consulta
+        autocommit=True,
+    )
+
+class MySQLPool:
+    """Pool pequeno de conexiones a DB_CONFIG.
+
+    - como mucho max_size conexiones abiertas; si estan todas prestadas se espera
+    - las libres que superan idle_timeout se cierran
+    - ping al prestar una conexion; si no responde se abre otra
+    - una conexion que sale con error se descarta en vez de volver al pool
+    """
+
+    def __init__(self, max_size: int = DB_POOL_SIZE, idle_timeout: float = DB_POOL_IDLE_TIMEOUT,
+                 wait_timeout: float = DB_POOL_WAIT_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._libres = []  # (conn, devuelta_en); la ultima es la mas reciente
+        self._abiertas = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _cerrar(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        limite = time.monotonic() + self.wait_timeout
+        conn = None
+        with self._cond:
+            while True:
+                ahora = time.monotonic()
+                while self._libres and ahora - self._libres[0][1] > self.idle_timeout:
+                    self._cerrar(self._libres.pop(0)[0])
+                    self._abiertas -= 1
+                if self._libres:
+                    conn = self._libres.pop()[0]
+                    break
+                if self._abiertas < self.max_size:
+                    self._abiertas += 1  # hueco reservado; se conecta fuera del lock
+                    break
+                if ahora >= limite or not self._cond.wait(limite - ahora):
+                    raise TimeoutError("pool de DB agotado")
+        if conn is not None:
+            try:
+                conn.ping(reconnect=False)
+                with self._cond:
+                    self.reused += 1
+                return conn
+            except Exception:
+                self._cerrar(conn)
+                with self._cond:
+                    self.discarded += 1
+        try:
+            conn = _db_connect()
+        except Exception:
+            with self._cond:
+                self._abiertas -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _checkin(self, conn, ok: bool) -> None:
+        if ok and conn.open:
+            with self._cond:
+                self._libres.append((conn, time.monotonic()))
+                self._cond.notify()
+            return
+        self._cerrar(conn)
+        with self._cond:
+            self.discarded += 1
+            self._abiertas -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        ok = False
+        try:
+            yield conn
+            ok = True
+        finally:
+            self._checkin(conn, ok)
+
+    def close_all(self) -> None:
+        with self._cond:
+            for conn, _ in self._libres:
+                self._cerrar(conn)
+            self._abiertas -= len(self._libres)
+            self._libres.clear()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "open": self._abiertas,
+                "idle": len(self._libres),
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+            }
+
+db_pool = MySQLPool()
+
+DATA_DIR = os.getenv("APPJ1_DATA_DIR", "data")
+
+# --------- modo incremental ---------
+DB_INCREMENTAL = os.getenv("APPJ1_INCREMENTAL", "0") == "1"
+# tablas con fecha de modificacion en el CRM (EspoCRM las guarda en UTC);
+# las tablas de relacion y email_address no tienen, sus cambios entran en la resincronizacion diaria
+INCREMENTAL_TABLAS = ("vehiculo", "conductor", "`user`")
+INCREMENTAL_LOTE_IDS = 500  # vehiculo_id por consulta al releer los tocados
+
+# estado local: vehiculo_id, matricula, fecha ITV, conductor, centro y direccion
+ESTADO_SELECT = """
+    SELECT 
+        vehiculo.id,
+        vehiculo.name,
+        vehiculo.fecha_prxima_i_t_v,
+        conductor.first_name,
+        user.centro_de_trabajo,
+        email_address.name"""
+
+class IncrementalState:
+    """Estado local (SQLite) de lo ultimo procesado por vehiculo.
+
+    La primera ejecucion de cada dia hace una resincronizacion completa de la
+    ventana; las siguientes solo piden a la DB las filas cuya fecha de
+    modificacion es posterior a la marca de agua. Los avisos del dia salen
+    del estado local, sin volver a recorrer la ventana en el CRM.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.path.join(DATA_DIR, "estado.db")
+        self._lock = threading.Lock()
+        self._listo = False
+
+    def _db(self):
+        if not self._listo:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with closing(sqlite3.connect(self.path)) as db, db:
+                db.executescript("""
+                    CREATE TABLE IF NOT EXISTS vehiculo_estado (
+                        vehiculo_id TEXT NOT NULL,
+                        email TEXT NOT NULL,
+                        matricula TEXT,
+                        fecha_itv TEXT,
+                        first_name TEXT,
+                        centro_de_trabajo TEXT,
+                        PRIMARY KEY (vehiculo_id, email)
+                    );
+                    CREATE INDEX IF NOT EXISTS ix_vehiculo_estado_fecha ON vehiculo_estado (fecha_itv);
+                    CREATE TABLE IF NOT EXISTS marca (clave TEXT PRIMARY KEY, valor TEXT);
+                """)
+            self._listo = True
+        return closing(sqlite3.connect(self.path))
+
+    def _marca(self, db, clave: str) -> str | None:
+        fila = db.execute("SELECT valor FROM marca WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    @staticmethod
+    def _registro(r) -> tuple:
+        vehiculo_id, matricula, fecha, first_name, centro, email = r[:6]
+        fecha = fecha.date() if isinstance(fecha, datetime) else fecha
+        return (str(vehiculo_id), email, matricula, fecha.isoformat() if fecha else None, first_name, centro)
+
+    def sync(self) -> dict:
+        """Actualiza el estado local desde la DB (completa o incremental)."""
+        hoy = datetime.now().date().isoformat()
+        with self._lock, self._db() as db:
+            marca = self._marca(db, "marca_agua")
+            completa = marca is None or self._marca(db, "ultima_completa") != hoy
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                # la marca se toma antes de leer: lo modificado durante la lectura se repite la proxima vez
+                cur.execute("SELECT UTC_TIMESTAMP()")
+                nueva_marca = str(cur.fetchone()[0])
+                if completa:
+                    cur.execute(f"""{ESTADO_SELECT}
+    {ITV_FROM}    WHERE 
+        vehiculo.fecha_prxima_i_t_v < CURDATE() + INTERVAL %s DAY
+        AND vehiculo.deleted = 0
+        AND vehiculo_conductor.deleted = 0
+    """, [VENTANA_DIAS])
+                    filas = cur.fetchall()
+                    tocados = None
+                else:
+                    tocados = self._tocados(cur, marca)
+                    filas = self._releer(cur, tocados)
+            with db:
+                if completa:
+                    db.execute("DELETE FROM vehiculo_estado")
+                else:
+                    # se sustituyen todas las filas del vehiculo (todos sus conductores), no solo las modificadas;
+                    # un vehiculo borrado o fuera de la ventana no vuelve en la relectura y sale del estado
+                    db.executemany("DELETE FROM vehiculo_estado WHERE vehiculo_id = ?", [(v,) for v in tocados])
+                db.executemany(
+                    "INSERT OR REPLACE INTO vehiculo_estado VALUES (?, ?, ?, ?, ?, ?)",
+                    [self._registro(r) for r in filas],
+                )
+                db.execute("INSERT OR REPLACE INTO marca VALUES ('marca_agua', ?)", (nueva_marca,))
+                if completa:
+                    db.execute("INSERT OR REPLACE INTO marca VALUES ('ultima_completa', ?)", (hoy,))
+        return {"completa": completa, "filas": len(filas), "vehiculos_tocados": None if tocados is None else len(tocados)}
+
+    @staticmethod
+    def _tocados(cur, marca: str) -> list:
+        """vehiculo_id con algo modificado despues de la marca.
+
+        Una consulta por tabla unidas con UNION: cada rama filtra solo por las
+        fechas de su tabla y puede usar su indice. Sin filtro de deleted ni de
+        ventana, para que un vehiculo borrado o con la ITV ya pasada tambien
+        salga y se quite del estado. Las filas sin modified_at cuentan por
+        created_at (si no, GREATEST daria NULL y no se verian nunca).
+        """
+        ramas, params = [], []
+        for tabla in INCREMENTAL_TABLAS:
+            ramas.append(f"""SELECT vehiculo.id
+    {ITV_FROM}    WHERE {tabla}.modified_at > %s OR ({tabla}.modified_at IS NULL AND {tabla}.created_at > %s)""")
+            params += [marca, marca]
+        cur.execute("\nUNION\n".join(ramas), params)
+        return sorted({str(r[0]) for r in cur.fetchall()})
+
+    @staticmethod
+    def _releer(cur, tocados: list) -> list:
+        # todas las filas vigentes de los vehiculos tocados, con el mismo filtro que la resincronizacion completa
+        filas = []
+        for i in range(0, len(tocados), INCREMENTAL_LOTE_IDS):
+            ids = tocados[i:i + INCREMENTAL_LOTE_IDS]
+            cur.execute(f"""{ESTADO_SELECT}
+    {ITV_FROM}    WHERE 
+        vehiculo.id IN ({", ".join(["%s"] * len(ids))})
+        AND vehiculo.fecha_prxima_i_t_v < CURDATE() + INTERVAL %s DAY
+        AND vehiculo.deleted = 0
+        AND vehiculo_conductor.deleted = 0
+    """, [*ids, VENTANA_DIAS])
+            filas.extend(cur.fetchall())
+        return filas
+
+    def filas_del_dia(self, politica: tuple) -> list:
+        """Filas de hoy calculadas sobre el estado local con la politica del dia."""
+        hoy = datetime.now().date()
+        limite = (hoy + timedelta(days=VENTANA_DIAS)).isoformat()
+        with self._lock, self._db() as db:
+            registros = db.execute(
+                "SELECT matricula, fecha_itv, first_name, centro_de_trabajo, email "
+                "FROM vehiculo_estado WHERE fecha_itv < ? ORDER BY fecha_itv, matricula",
+                (limite,),
+            ).fetchall()
+        filas = []
+        for matricula, fecha_itv, first_name, centro, email in registros:
+            fecha = datetime.strptime(fecha_itv, "%Y-%m-%d").date()
+            dias = (fecha - hoy).days
+            if debe_enviar(dias, politica):
+                filas.append(FilaITV(matricula, fecha.strftime("%d/%m/%Y"), first_name, centro, email, dias))
+        return filas
+
+incremental_state = IncrementalState()
+
+def get_data_incremental(politica: tuple):
     try:
-        conn = pymysql.connect(
-            host=DB_CONFIG["host"],
-            user=DB_CONFIG["user"],
-            password=DB_CONFIG["password"],
-            database=DB_CONFIG["database"],
-            port=DB_CONFIG["port"],
-            charset="utf8mb4",
-            cursorclass=pymysql.cursors.Cursor,
-            connect_timeout=10,
-            read_timeout=30,
-            write_timeout=30,
-        )
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            return cur.fetchall()
+        r = incremental_state.sync()
+        log(f"estado incremental actualizado: {r}")
+        return incremental_state.filas_del_dia(politica)
     except Exception as e:
-        log(f"error DB: {e}")
+        log(f"error DB (incremental): {e}", "error")
         return None
+
+# --------- cache de la consulta ITV ---------
+QUERY_CACHE_TTL = float(os.getenv("APPJ1_QUERY_CACHE_TTL", "3600"))  # segundos; 0 desactiva la cache
+QUERY_CACHE_DISK = os.getenv("APPJ1_QUERY_CACHE_DISK", "0") == "1"  # guarda tambien en DATA_DIR
+# en streaming guardar la foto obliga a tener todas las filas en memoria, que es lo que el cursor evita
+QUERY_CACHE_STREAM = os.getenv("APPJ1_QUERY_CACHE_STREAM", "0") == "1"
+
+class QueryCache:
+    """Foto del resultado de la consulta ITV por dia.
+
+    La clave es (fecha de hoy, huella de sql+parametros): el resultado solo
+    depende de CURDATE(), asi que reintentos y repeticiones del mismo dia no
+    vuelven a la DB. Caduca a los ttl segundos y se puede invalidar a mano.
+    Al guardar la foto de hoy se borran las de otros dias, tambien en disco.
+    """
+
+    def __init__(self, ttl: float = QUERY_CACHE_TTL, disk_dir: str | None = DATA_DIR if QUERY_CACHE_DISK else None):
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._fotos = {}  # clave -> (creada_en, filas)
+        self.hits = 0
+        self.misses = 0
+
+    def _clave(self, sql: str, params) -> tuple:
+        huella = hashlib.sha1(json.dumps([sql, list(params or [])]).encode("utf-8")).hexdigest()[:16]
+        return datetime.now().date().isoformat(), huella
+
+    def _ruta(self, clave: tuple) -> str:
+        return os.path.join(self.disk_dir, f"consulta_{clave[0]}_{clave[1]}.json")
+
+    def get(self, sql: str, params) -> list | None:
+        if self.ttl <= 0:
+            return None
+        clave = self._clave(sql, params)
+        with self._lock:
+            foto = self._fotos.get(clave)
+        if foto is None and self.disk_dir:
+            try:
+                with open(self._ruta(clave), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                foto = (data["creada_en"], [FilaITV._make(r) for r in data["filas"]])
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log(f"cache: no se pudo leer {self._ruta(clave)}: {e}", "warning")
+        with self._lock:
+            if foto is not None and time.time() - foto[0] < self.ttl:
+                self._fotos[clave] = foto
+                self.hits += 1
+                return foto[1]
+            self._fotos.pop(clave, None)
+            self.misses += 1
+            return None
+
+    def put(self, sql: str, params, filas: list) -> None:
+        if self.ttl <= 0:
+            return
+        clave = self._clave(sql, params)
+        foto = (time.time(), list(filas))
+        with self._lock:
+            # las fotos de otros dias ya no se van a pedir
+            for k in [k for k in self._fotos if k[0] != clave[0]]:
+                del self._fotos[k]
+            self._fotos[clave] = foto
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                tmp = self._ruta(clave) + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"creada_en": foto[0], "filas": foto[1]}, f)
+                os.replace(tmp, self._ruta(clave))
+            except Exception as e:
+                log(f"cache: no se pudo guardar {self._ruta(clave)}: {e}", "warning")
+            self._borrar_ficheros(conservar=clave[0])
+
+    def _borrar_ficheros(self, conservar: str | None = None) -> None:
+        # conservar: fecha cuyos ficheros se mantienen (None borra todos)
+        if not self.disk_dir or not os.path.isdir(self.disk_dir):
+            return
+        for nombre in os.listdir(self.disk_dir):
+            if not (nombre.startswith("consulta_") and nombre.endswith(".json")):
+                continue
+            if conservar and nombre.startswith(f"consulta_{conservar}_"):
+                continue
+            try:
+                os.remove(os.path.join(self.disk_dir, nombre))
+            except OSError:
+                pass
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._fotos.clear()
+        self._borrar_ficheros()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._fotos), "ttl": self.ttl}
+
+query_cache = QueryCache()
+
+class DBReadError(RuntimeError):
+    # get_data_from_db devolvio None: la consulta fallo, no es que no haya filas
+    def __init__(self):
+        super().__init__("no se pudieron leer las filas de la DB")
+
+def get_data_from_db(politica: tuple | None = None):
+    if politica is None:
+        politica = politica_del_dia()
+    if DB_INCREMENTAL:
+        t0 = time.perf_counter()
+        filas = get_data_incremental(politica)
+        if filas is None:
+            M_DB_ERRORES.inc(origen="incremental")
+        else:
+            M_DB_SEGUNDOS.observe(time.perf_counter() - t0, origen="incremental")
+            M_DB_FILAS.inc(len(filas), origen="incremental")
+        return filas
+    sql, params = itv_query(politica)
+    if sql is None:
+        return []
+    filas = query_cache.get(sql, params)
+    if filas is not None:
+        M_DB_FILAS.inc(len(filas), origen="cache")
+        return filas
+    t0 = time.perf_counter()
+    try:
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            filas = [FilaITV._make(r) for r in cur.fetchall()]
+    except Exception as e:
+        M_DB_ERRORES.inc(origen="mysql")
+        log(f"error DB: {e}", "error")
+        return None
+    M_DB_SEGUNDOS.observe(time.perf_counter() - t0, origen="mysql")
+    M_DB_FILAS.inc(len(filas), origen="mysql")
+    query_cache.put(sql, params, filas)
+    return filas
+
+def iter_data_from_db(politica: tuple | None = None):
+    """Como get_data_from_db pero con SSCursor: genera las filas segun llegan.
+
+    El resultado no se carga entero en memoria y el primer correo sale antes
+    de terminar la lectura. Un error de DB se registra y se relanza, para que
+    quien consume no confunda una lectura cortada con el final de los datos.
+    Se sirve de la foto del dia si ya esta en cache, pero solo la guarda con
+    APPJ1_QUERY_CACHE_STREAM=1 (exige tener todas las filas en memoria); la
+    foto solo se publica si la lectura termina completa.
+    """
+    if politica is None:
+        politica = politica_del_dia()
+    if DB_INCREMENTAL:
+        # el estado local ya es pequeno y esta en disco: no hace falta cursor de servidor
+        yield from get_data_incremental(politica) or ()
+        return
+    sql, params = itv_query(politica)
+    if sql is None:
+        return
+    filas = query_cache.get(sql, params)
+    if filas is not None:
+        M_DB_FILAS.inc(len(filas), origen="cache")
+        yield from filas
+        return
+    foto = [] if QUERY_CACHE_STREAM and query_cache.ttl > 0 else None
+    n = 0
+    t0 = time.perf_counter()
+    try:
+        # si se abandona a medias, la conexion se descarta en vez de volver al pool
+        with db_pool.connection() as conn, conn.cursor(pymysql.cursors.SSCursor) as cur:
+            cur.execute(sql, params)
+            # el tiempo de la consulta en streaming es hasta la primera fila
+            M_DB_SEGUNDOS.observe(time.perf_counter() - t0, origen="mysql_stream")
+            for r in cur:
+                fila = FilaITV._make(r)
+                n += 1
+                if foto is not None:
+                    foto.append(fila)
+                yield fila
+    except Exception as e:
+        M_DB_ERRORES.inc(origen="mysql_stream")
+        log(f"error DB: {e}", "error", filas_leidas=n)
+        raise
     finally:
+        M_DB_FILAS.inc(n, origen="mysql_stream")
+    if foto is not None:
+        query_cache.put(sql, params, foto)
+
+# --------- transporte HTTP compartido ---------
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "10"))
+GRAPH_HTTP2 = os.getenv("GRAPH_HTTP2", "0") == "1"  # requiere el paquete h2
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "10"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "30"))
+GRAPH_KEEPALIVE_EXPIRY = float(os.getenv("GRAPH_KEEPALIVE_EXPIRY", "60"))
+
+class GraphHttp:
+    """Cliente httpx unico (pool keep-alive) para token y Graph.
+
+    Cuenta peticiones y conexiones TCP nuevas para saber cuanto se reutiliza.
+    """
+
+    def __init__(self, pool_size: int = GRAPH_POOL_SIZE, http2: bool = GRAPH_HTTP2,
+                 connect_timeout: float = GRAPH_CONNECT_TIMEOUT, read_timeout: float = GRAPH_READ_TIMEOUT,
+                 keepalive_expiry: float = GRAPH_KEEPALIVE_EXPIRY):
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._lock = threading.Lock()
+        self._client = None
+        self._http2_efectivo = None
+        self.requests = 0
+        self.new_connections = 0
+
+    @property
+    def http2_efectivo(self) -> bool:
+        # GRAPH_HTTP2 sin el paquete h2 instalado: HTTP/1.1 (vale para el cliente sync y el async)
+        if self._http2_efectivo is None:
+            http2 = self.http2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    log("h2 no instalado, se usa HTTP/1.1", "warning")
+                    http2 = False
+            self._http2_efectivo = http2
+        return self._http2_efectivo
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(http2=self.http2_efectivo, limits=self.limits, timeout=self.timeout)
+        return self._client
+
+    def _trace(self, event: str, info: dict) -> None:
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": self._trace}
+        with self._lock:
+            self.requests += 1
+        t0 = time.perf_counter()
+        status = "error"
         try:
-            if conn: conn.close()
-        except Exception:
-            pass
+            r = self.client.request(method, url, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            M_GRAPH_SEGUNDOS.observe(time.perf_counter() - t0, endpoint=_endpoint(url), status=status)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused": max(self.requests - self.new_connections, 0),
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+graph_http = GraphHttp()
 
 # --------- Graph helpers ---------
-def graph_token() -> str:
-    url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "scope": "https://graph.microsoft.com/.default",
-        "grant_type": "client_credentials",
-    }
-    r = requests.post(url, data=data, timeout=30)
-    r.raise_for_status()
-    return r.json()["access_token"]
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+# URLs base configurables (p. ej. el servidor falso de bench_appj1.py)
+GRAPH_LOGIN_URL = os.getenv("GRAPH_LOGIN_URL", "https://login.microsoftonline.com").rstrip("/")
+TOKEN_REFRESH_MARGIN = int(os.getenv("GRAPH_TOKEN_REFRESH_MARGIN", "300"))  # segundos antes de caducar
 
-def send_mail_graph(to_list, cc_list, bcc_list, subject, html, inline_png_path: str | None = None):
+class GraphTokenProvider:
+    """Cachea el token de client credentials y lo renueva poco antes de caducar.
+
+    Una sola peticion de token en vuelo (single-flight): los hilos que llegan
+    mientras se renueva esperan al lock y reutilizan el token nuevo.
+    """
+
+    def __init__(self, margin: int = TOKEN_REFRESH_MARGIN):
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    def _fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.margin
+
+    def get(self, force: bool = False) -> str:
+        token = self._token
+        if not force and self._fresh():
+            return token
+        with self._lock:
+            # otro hilo puede haberlo renovado mientras esperabamos
+            if self._token is not None and (self._token != token or not force) and self._fresh():
+                return self._token
+            url = f"{GRAPH_LOGIN_URL}/{TENANT_ID}/oauth2/v2.0/token"
+            data = {
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET,
+                "scope": GRAPH_SCOPE,
+                "grant_type": "client_credentials",
+            }
+            M_TOKEN_RENOVACIONES.inc()
+            r = graph_http.post(url, data=data)
+            r.raise_for_status()
+            body = r.json()
+            self._token = body["access_token"]
+            self._expires_at = time.monotonic() + int(body.get("expires_in", 3599))
+            return self._token
+
+    def cached(self) -> str | None:
+        # token vigente sin bloquear (None si hay que renovarlo)
+        token = self._token
+        return token if self._fresh() else None
+
+    def invalidate(self, token: str | None = None) -> None:
+        # solo descarta si sigue siendo el token rechazado (evita tirar uno recien renovado)
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+token_provider = GraphTokenProvider()
+
+def graph_token(force: bool = False) -> str:
+    return token_provider.get(force=force)
+
+GRAPH_URL = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0").rstrip("/")
+GRAPH_BATCH_SIZE = 20  # maximo de subrequests que admite Graph en un $batch
+GRAPH_BATCH_RETRIES = int(os.getenv("GRAPH_BATCH_RETRIES", "3"))
+GRAPH_RETRYABLE = {429, 500, 502, 503, 504}
+# errores de red en los que la peticion no llego a salir: reintentarlos no duplica correos
+# (un ReadTimeout o una conexion cortada tras enviar el cuerpo pueden haber entregado el sendMail)
+GRAPH_RED_REINTENTABLE = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5"))
+GRAPH_BACKOFF_BASE = float(os.getenv("GRAPH_BACKOFF_BASE", "1"))
+GRAPH_BACKOFF_MAX = float(os.getenv("GRAPH_BACKOFF_MAX", "60"))
+BREAKER_THRESHOLD = int(os.getenv("APPJ1_BREAKER_THRESHOLD", "10"))  # fallos seguidos que abren el circuito
+
+class GraphBatchError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status} {message}")
+        self.status = status
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+def _es_limitacion(status: int, retry_after: float) -> bool:
+    # 429, o 503 con Retry-After: Graph pide bajar el ritmo, no esta fallando
+    return status == 429 or (status == 503 and retry_after > 0)
+
+class MailboxThrottled(Exception):
+    # 429/503 de un buzon cuando hay otros remitentes a los que pasar el envio
+    def __init__(self, status: int, retry_after: float):
+        super().__init__(f"{status} buzon limitado (Retry-After {retry_after:g}s)")
+        self.status = status
+        self.retry_after = retry_after
+
+class DeliveryController:
+    """Controla la entrega contra Graph durante una ejecucion.
+
+    - limite de peticiones en vuelo AIMD: +1 por cada ventana de exitos,
+      /2 cuando Graph responde 429/503 (como mucho una vez por segundo)
+    - pausa global hasta que vence el Retry-After
+    - backoff exponencial con jitter para los reintentos
+    - circuit breaker: tras BREAKER_THRESHOLD fallos seguidos corta la ejecucion;
+      un 429 (o 503 con Retry-After) es limitacion, no fallo: solo mueve el
+      limite y la pausa
+    """
+
+    def __init__(self, max_limit: int = 1, breaker_threshold: int = BREAKER_THRESHOLD):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.breaker_threshold = breaker_threshold
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._window = 0
+        self._last_decrease = 0.0
+        self._pause_until = 0.0
+        self.consecutive_failures = 0
+        self.open = False
+        self.throttled = 0
+        self.retries = 0
+
+    def acquire(self) -> None:
+        with self._cond:
+            while not self.open and self._in_flight >= self.limit:
+                self._cond.wait()
+            if self.open:
+                raise self._circuito_abierto()
+            self._in_flight += 1
+            pausa = self._pause_until - time.monotonic()
+        if pausa > 0:
+            time.sleep(pausa)
+
+    def release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self.consecutive_failures = 0
+            self._window += 1
+            if self._window >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self._window = 0
+                self._cond.notify()
+
+    def on_failure(self) -> None:
+        with self._cond:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.breaker_threshold:
+                self.open = True
+                self._cond.notify_all()
+
+    def on_throttle(self, retry_after: float = 0.0) -> None:
+        ahora = time.monotonic()
+        with self._cond:
+            self.throttled += 1
+            if ahora - self._last_decrease >= 1.0:
+                self.limit = max(1, self.limit // 2)
+                self._window = 0
+                self._last_decrease = ahora
+            if retry_after:
+                self._pause_until = max(self._pause_until, ahora + retry_after)
+
+    def _circuito_abierto(self) -> CircuitOpenError:
+        return CircuitOpenError(f"circuito abierto tras {self.consecutive_failures} fallos seguidos")
+
+    def _espera(self, intento: int, retry_after: float = 0.0) -> float:
+        if self.open:
+            raise self._circuito_abierto()
+        with self._cond:
+            self.retries += 1
+        if retry_after:
+            return retry_after + random.uniform(0, GRAPH_BACKOFF_BASE)
+        tope = min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** intento)
+        return tope / 2 + random.uniform(0, tope / 2)
+
+    def wait(self, intento: int, retry_after: float = 0.0) -> None:
+        time.sleep(self._espera(intento, retry_after))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "circuit_open": self.open,
+            }
+
+def _graph_post_once(url: str, payload: dict) -> httpx.Response:
     token = graph_token()
-    url = f"https://graph.microsoft.com/v1.0/users/{SENDER_UPN}/sendMail"
+    r = graph_http.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    if r.status_code == 401:
+        # token revocado o caducado antes de tiempo: renovar una vez y reintentar
+        token_provider.invalidate(token)
+        token = graph_token()
+        r = graph_http.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    return r
+
+def graph_post(url: str, payload: dict, ctl: DeliveryController | None = None,
+               shift_throttle: bool = False) -> httpx.Response:
+    # reintenta 429/5xx y errores de conexion respetando Retry-After; el resto de errores sube tal cual
+    # shift_throttle: un 429/503 no se reintenta aqui sino que sube como MailboxThrottled
+    ctl = ctl or DeliveryController()
+    intento = 0
+    while True:
+        ctl.acquire()
+        try:
+            r = _graph_post_once(url, payload)
+        except httpx.TransportError as e:
+            ctl.on_failure()
+            if intento >= GRAPH_MAX_RETRIES or not isinstance(e, GRAPH_RED_REINTENTABLE):
+                raise
+            r = None
+        finally:
+            ctl.release()
+        if r is None:
+            ctl.wait(intento)
+            M_GRAPH_REINTENTOS.inc(endpoint=_endpoint(url), motivo="red")
+            intento += 1
+            continue
+        if r.status_code in GRAPH_RETRYABLE:
+            retry_after = _retry_after(r.headers)
+            if shift_throttle and r.status_code in (429, 503):
+                raise MailboxThrottled(r.status_code, retry_after)
+            if r.status_code in (429, 503):
+                ctl.on_throttle(retry_after)
+            if not _es_limitacion(r.status_code, retry_after):
+                ctl.on_failure()
+            if intento >= GRAPH_MAX_RETRIES:
+                r.raise_for_status()
+            ctl.wait(intento, retry_after)
+            M_GRAPH_REINTENTOS.inc(endpoint=_endpoint(url), motivo=r.status_code)
+            intento += 1
+            continue
+        if r.status_code in (401, 403):
+            ctl.on_failure()
+        r.raise_for_status()
+        ctl.on_success()
+        return r
+
+# --------- buzones remitentes ---------
+SENDER_STRATEGY = os.getenv("APPJ1_SENDER_STRATEGY", "least_load")  # least_load | round_robin
+# ritmo y concurrencia por buzon: por defecto sin limite (manda el AIMD con los 429 de Graph); se fijan
+# cuando hay que quedarse por debajo de un limite conocido, p. ej. APPJ1_SENDER_PER_MINUTE=30 en Exchange Online
+SENDER_PER_MINUTE = float(os.getenv("APPJ1_SENDER_PER_MINUTE", "0"))  # mensajes por minuto y buzon (0: sin limite)
+SENDER_DAILY_RECIPIENTS = int(os.getenv("APPJ1_SENDER_DAILY_RECIPIENTS", "10000"))  # destinatarios por dia y buzon (0: sin limite)
+SENDER_CONCURRENCY = int(os.getenv("APPJ1_SENDER_CONCURRENCY", "0"))  # peticiones en vuelo por buzon (0: sin limite)
+SENDER_THROTTLE_PAUSE = 30.0  # pausa de un buzon limitado si Graph no manda Retry-After
+SENDER_PERSIST_SECONDS = float(os.getenv("APPJ1_SENDER_PERSIST_SECONDS", "1"))  # cada cuanto se guarda el uso diario
+M_REMITENTE_LIMITADO = metricas.contador("appj1_sender_throttled_total", "429/503 recibidos por buzon remitente", ("remitente",))
+
+def _sender_upns(path: str = "config.json") -> list:
+    # GRAPH_SENDER_UPNS (separados por comas) > "remitentes" de config.json > GRAPH_SENDER_UPN
+    upns = [x.strip() for x in os.getenv("GRAPH_SENDER_UPNS", "").split(",") if x.strip()]
+    if not upns:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                upns = [x.strip() for x in json.loads(f.read()).get("remitentes", []) if x.strip()]
+        except Exception:
+            upns = []
+    return list(dict.fromkeys(upns)) or [SENDER_UPN]
+
+class SenderQuotaError(RuntimeError):
+    pass
+
+def _resolver(fut) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+class Remitente:
+    def __init__(self, upn: str, capacidad: float):
+        self.upn = upn
+        self.tokens = capacidad
+        self.repuesto = time.monotonic()
+        self.en_vuelo = 0  # peticiones propias en curso (limite de concurrencia)
+        self.pendientes = 0  # asignados y sin confirmar, incluidos subrequests de $batch
+        self.pausa_hasta = 0.0
+        self.mensajes = 0  # hoy
+        self.destinatarios = 0  # hoy
+        self.limitado = 0
+
+class SenderPool:
+    """Reparte los sendMail entre varios buzones remitentes.
+
+    - por buzon: cubo de tokens de per_minute mensajes/minuto, como mucho
+      concurrency peticiones en vuelo y daily_recipients destinatarios al dia
+      (0 en cualquiera: sin ese limite)
+    - eleccion round_robin o least_load (menos pendientes, luego menos enviados hoy)
+    - un 429/503 pausa ese buzon hasta que vence el Retry-After y el envio
+      pasa a otro; si todos estan pausados o sin cupo se espera
+    - el uso diario se guarda en DATA_DIR/remitentes.db (sobrevive a reinicios
+      y lo comparten los procesos) por tandas, cada SENDER_PERSIST_SECONDS
+    """
+
+    def __init__(self, upns: list, strategy: str = SENDER_STRATEGY, per_minute: float = SENDER_PER_MINUTE,
+                 daily_recipients: int = SENDER_DAILY_RECIPIENTS, concurrency: int = SENDER_CONCURRENCY,
+                 path: str | None = None):
+        self.strategy = strategy
+        self.per_minute = per_minute
+        self.daily_recipients = daily_recipients
+        self.concurrency = max(0, concurrency)
+        self.path = path or os.path.join(DATA_DIR, "remitentes.db")
+        self._cond = threading.Condition()
+        self._remitentes = [Remitente(u, per_minute or 1) for u in upns]
+        self._turno = 0
+        self._fecha = None
+        self._db = None
+        self._db_lock = threading.Lock()  # una escritura de uso a la vez, sin bloquear _cond
+        self._sin_guardar = {}  # (fecha, upn) -> (mensajes, destinatarios) aun no guardados
+        self._guardado = time.monotonic()
+        self._esperando = []  # (loop, future) de acquire_async
+
+    @property
+    def varios(self) -> bool:
+        return len(self._remitentes) > 1
+
+    def _conexion(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS uso (fecha TEXT, upn TEXT, mensajes INTEGER, destinatarios INTEGER, "
+                "PRIMARY KEY (fecha, upn))"
+            )
+        return self._db
+
+    def _nuevo_dia(self) -> None:
+        # con el lock tomado: al cambiar de dia se cargan los contadores guardados
+        hoy = datetime.now().date().isoformat()
+        if hoy == self._fecha:
+            return
+        self._fecha = hoy
+        try:
+            uso = dict(((u, (m, d)) for u, m, d in self._conexion().execute(
+                "SELECT upn, mensajes, destinatarios FROM uso WHERE fecha = ?", (hoy,))))
+        except sqlite3.Error as e:
+            log(f"remitentes: no se pudo leer el uso diario: {e}", "warning")
+            uso = {}
+        for r in self._remitentes:
+            r.mensajes, r.destinatarios = uso.get(r.upn, (0, 0))
+
+    def _reponer(self, r: Remitente, ahora: float) -> None:
+        if self.per_minute > 0:
+            r.tokens = min(self.per_minute, r.tokens + (ahora - r.repuesto) * self.per_minute / 60)
+        r.repuesto = ahora
+
+    def _elegir(self, destinatarios: int, ocupar: bool = True) -> tuple:
+        # (remitente o None, segundos hasta que alguno pueda tener hueco)
+        # ocupar=False: solo gasta ritmo y cupo (subrequests de $batch, que no son peticiones propias)
+        ahora = time.monotonic()
+        self._nuevo_dia()
+        libres, espera, con_cupo = [], None, False
+        for r in self._remitentes:
+            if self.daily_recipients and r.destinatarios + destinatarios > self.daily_recipients:
+                continue
+            con_cupo = True
+            self._reponer(r, ahora)
+            if r.pausa_hasta > ahora:
+                falta = r.pausa_hasta - ahora
+            elif ocupar and self.concurrency and r.en_vuelo >= self.concurrency:
+                falta = 0.05
+            elif self.per_minute > 0 and r.tokens < 1:
+                falta = (1 - r.tokens) * 60 / self.per_minute
+            else:
+                libres.append(r)
+                continue
+            espera = falta if espera is None else min(espera, falta)
+        if not con_cupo:
+            raise SenderQuotaError(f"cupo diario agotado en todos los remitentes ({self.daily_recipients} destinatarios)")
+        if not libres:
+            return None, espera
+        if self.strategy == "round_robin":
+            n = len(self._remitentes)
+            orden = [self._remitentes[(self._turno + i) % n] for i in range(n)]
+            r = next(x for x in orden if x in libres)
+            self._turno = (self._remitentes.index(r) + 1) % n
+        else:
+            r = min(libres, key=lambda x: (x.pendientes, x.destinatarios))
+        r.pendientes += 1
+        if ocupar:
+            r.en_vuelo += 1
+        if self.per_minute > 0:
+            r.tokens -= 1
+        return r, 0.0
+
+    def acquire(self, destinatarios: int = 1, ocupar: bool = True) -> str:
+        with self._cond:
+            while True:
+                r, espera = self._elegir(destinatarios, ocupar)
+                if r is not None:
+                    return r.upn
+                self._cond.wait(espera)
+
+    async def acquire_async(self, destinatarios: int = 1) -> str:
+        # sin sondeo: espera a que un release/on_throttle lo despierte o a que venza la espera
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                r, espera = self._elegir(destinatarios)
+                if r is not None:
+                    return r.upn
+                fut = loop.create_future()
+                self._esperando.append((loop, fut))
+            try:
+                await asyncio.wait((fut,), timeout=espera)
+            finally:
+                with self._cond:
+                    if (loop, fut) in self._esperando:
+                        self._esperando.remove((loop, fut))
+
+    def _despertar(self) -> None:
+        # con el lock tomado; release puede llegar desde otro hilo
+        self._cond.notify_all()
+        for loop, fut in self._esperando:
+            loop.call_soon_threadsafe(_resolver, fut)
+        self._esperando.clear()
+
+    def release(self, upn: str, destinatarios: int = 0, ocupar: bool = True) -> None:
+        # destinatarios > 0: enviado; cuenta para el cupo diario. Solo toca memoria:
+        # el uso se guarda aparte con guardar_uso, fuera del lock
+        with self._cond:
+            r = next(x for x in self._remitentes if x.upn == upn)
+            r.pendientes -= 1
+            if ocupar:
+                r.en_vuelo -= 1
+            if destinatarios:
+                r.mensajes += 1
+                r.destinatarios += destinatarios
+                m, d = self._sin_guardar.get((self._fecha, upn), (0, 0))
+                self._sin_guardar[(self._fecha, upn)] = (m + 1, d + destinatarios)
+            self._despertar()
+
+    def uso_pendiente(self) -> bool:
+        # hay uso sin guardar y ya toca guardarlo
+        return bool(self._sin_guardar) and time.monotonic() - self._guardado >= SENDER_PERSIST_SECONDS
+
+    def guardar_uso(self, forzar: bool = False) -> None:
+        """Suma a remitentes.db el uso acumulado desde la ultima vez.
+
+        Como mucho una escritura cada SENDER_PERSIST_SECONDS (salvo forzar) y
+        sin el lock del pool, para no parar a los demas envios mientras SQLite
+        escribe. Lo que hayan enviado otros procesos con los mismos buzones se
+        recoge al volver a leer los totales.
+        """
+        if not forzar and not self.uso_pendiente():
+            return
+        # sin forzar, si ya esta guardando otro hilo no se espera: lo suyo entra en la siguiente tanda
+        if not self._db_lock.acquire(blocking=forzar):
+            return
+        try:
+            with self._cond:
+                pendiente, self._sin_guardar = self._sin_guardar, {}
+                self._guardado = time.monotonic()
+            if not pendiente:
+                return
+            db = self._conexion()
+            with db:
+                db.executemany(
+                    "INSERT INTO uso VALUES (?, ?, ?, ?) ON CONFLICT(fecha, upn) DO UPDATE SET "
+                    "mensajes = mensajes + excluded.mensajes, destinatarios = destinatarios + excluded.destinatarios",
+                    [(f, u, m, d) for (f, u), (m, d) in pendiente.items()],
+                )
+                # lo que hayan enviado otros procesos con los mismos buzones tambien cuenta
+                fechas = sorted({f for f, _ in pendiente})
+                filas = db.execute(
+                    f"SELECT fecha, upn, mensajes, destinatarios FROM uso WHERE fecha IN ({','.join('?' * len(fechas))})",
+                    fechas).fetchall()
+        except sqlite3.Error as e:
+            log(f"remitentes: no se pudo guardar el uso diario: {e}", "warning")
+            with self._cond:
+                # vuelve a lo pendiente para la siguiente tanda
+                for k, (m, d) in pendiente.items():
+                    m2, d2 = self._sin_guardar.get(k, (0, 0))
+                    self._sin_guardar[k] = (m + m2, d + d2)
+            return
+        finally:
+            self._db_lock.release()
+        with self._cond:
+            for fecha, upn, m, d in filas:
+                r = next((x for x in self._remitentes if x.upn == upn), None)
+                if r is not None and fecha == self._fecha:
+                    r.mensajes, r.destinatarios = max(r.mensajes, m), max(r.destinatarios, d)
 
+    def limite_en_vuelo(self) -> int:
+        # peticiones sendMail propias que admite el pool a la vez (0: sin limite)
+        return self.concurrency * len(self._remitentes)
+
+    def avisar_tope(self, motor: str, pedido: int) -> None:
+        # APPJ1_SENDER_CONCURRENCY manda sobre workers/concurrency del motor: que se vea en el log
+        tope = self.limite_en_vuelo()
+        if tope and pedido > tope:
+            log(f"{motor}: {pedido} envios en paralelo pedidos, pero los remitentes solo admiten {tope} en vuelo "
+                f"({len(self._remitentes)} buzones x APPJ1_SENDER_CONCURRENCY={self.concurrency})", "warning",
+                pedido=pedido, tope=tope)
+
+    def on_throttle(self, upn: str, retry_after: float = 0.0) -> None:
+        with self._cond:
+            r = next(x for x in self._remitentes if x.upn == upn)
+            r.limitado += 1
+            r.pausa_hasta = max(r.pausa_hasta, time.monotonic() + (retry_after or SENDER_THROTTLE_PAUSE))
+            self._despertar()
+        M_REMITENTE_LIMITADO.inc(remitente=upn)
+        log(f"remitente {upn} limitado por Graph, pausa {retry_after or SENDER_THROTTLE_PAUSE:g}s", "warning", remitente=upn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {r.upn: {"mensajes_hoy": r.mensajes, "destinatarios_hoy": r.destinatarios,
+                            "en_vuelo": r.en_vuelo, "limitado": r.limitado} for r in self._remitentes}
+
+remitentes = SenderPool(_sender_upns())
+atexit.register(remitentes.guardar_uso, True)
+
+def _num_destinatarios(payload: dict) -> int:
+    m = payload.get("message", {})
+    return max(1, sum(len(m.get(k, [])) for k in ("toRecipients", "ccRecipients", "bccRecipients")))
+
+def graph_sendmail(payload: dict, ctl: DeliveryController | None = None) -> httpx.Response:
+    """POST sendMail desde el buzon que toque del pool de remitentes.
+
+    Con varios remitentes un 429/503 pausa ese buzon y se reintenta en otro;
+    con uno solo se comporta como graph_post.
+    """
+    ctl = ctl or DeliveryController()
+    n = _num_destinatarios(payload)
+    cambios = 0
+    while True:
+        upn = remitentes.acquire(n)
+        ok = False
+        try:
+            r = graph_post(f"{GRAPH_URL}/users/{upn}/sendMail", payload, ctl, shift_throttle=remitentes.varios)
+            ok = True
+            return r
+        except MailboxThrottled as e:
+            remitentes.on_throttle(upn, e.retry_after)
+            if not _es_limitacion(e.status, e.retry_after):
+                ctl.on_failure()
+            cambios += 1
+            if cambios > GRAPH_MAX_RETRIES:
+                raise
+        finally:
+            remitentes.release(upn, n if ok else 0)
+            remitentes.guardar_uso()
+
+# --------- adjuntos inline ---------
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ASSET_CHECK_SECONDS = float(os.getenv("APPJ1_ASSET_CHECK_SECONDS", "5"))  # cada cuanto se mira si cambio el fichero
+
+class InlineAsset(NamedTuple):
+    path: str  # relativo a static/ o absoluto
+    content_id: str  # el cid: que usan las plantillas
+    name: str
+    content_type: str
+
+# imagenes que pueden referenciar las plantillas con src="cid:..."
+INLINE_ASSETS = {
+    "logo_tabisam": InlineAsset("image001.png", "logo_tabisam", "image001.png", "image/png"),
+}
+
+class AssetCache:
+    """fileAttachment de Graph ya codificado en base64, uno por fichero.
+
+    La clave es la ruta y el sha256 del contenido: cada fichero se lee y se
+    codifica una vez por proceso. Como mucho cada ASSET_CHECK_SECONDS se mira
+    el stat y, si cambio, se vuelve a leer (solo se recodifica si cambio el
+    hash). Los dict devueltos se comparten entre correos: no modificarlos.
+    """
+
+    def __init__(self, base_dir: str = STATIC_DIR, check_seconds: float = ASSET_CHECK_SECONDS):
+        self.base_dir = base_dir
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._entradas = {}  # asset -> (stat, sha256, adjunto, ultima comprobacion)
+        self._por_hash = {}  # (ruta, sha256) -> adjunto
+        self.lecturas = 0
+
+    def _ruta(self, asset: InlineAsset) -> str:
+        return asset.path if os.path.isabs(asset.path) else os.path.join(self.base_dir, asset.path)
+
+    def attachment(self, asset: InlineAsset) -> dict | None:
+        ahora = time.monotonic()
+        entrada = self._entradas.get(asset)
+        if entrada is not None and ahora - entrada[3] < self.check_seconds:
+            return entrada[2]
+        ruta = self._ruta(asset)
+        with self._lock:
+            entrada = self._entradas.get(asset)
+            if entrada is not None and ahora - entrada[3] < self.check_seconds:
+                return entrada[2]
+            try:
+                st = os.stat(ruta)
+            except OSError:
+                self._entradas[asset] = (None, None, None, ahora)
+                return None
+            firma = (st.st_mtime_ns, st.st_size)
+            if entrada is not None and entrada[0] == firma:
+                self._entradas[asset] = (firma, entrada[1], entrada[2], ahora)
+                return entrada[2]
+            with open(ruta, "rb") as f:
+                contenido = f.read()
+            self.lecturas += 1
+            sha = hashlib.sha256(contenido).hexdigest()
+            adjunto = self._por_hash.get((ruta, sha))
+            if adjunto is None or adjunto["contentId"] != asset.content_id:
+                adjunto = {
+                    "@odata.type": "#microsoft.graph.fileAttachment",
+                    "name": asset.name,
+                    "contentId": asset.content_id,
+                    "isInline": True,
+                    "contentBytes": base64.b64encode(contenido).decode("ascii"),
+                    "contentType": asset.content_type,
+                }
+                self._por_hash[(ruta, sha)] = adjunto
+            self._entradas[asset] = (firma, sha, adjunto, ahora)
+            return adjunto
+
+    def attachments(self, content_ids) -> list:
+        # los cid sin asset registrado o sin fichero se omiten, como antes con el logo
+        adjuntos = []
+        for cid in content_ids:
+            asset = INLINE_ASSETS.get(cid)
+            adjunto = self.attachment(asset) if asset else None
+            if adjunto is not None:
+                adjuntos.append(adjunto)
+        return adjuntos
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"assets": len(self._entradas), "versions": len(self._por_hash), "reads": self.lecturas}
+
+asset_cache = AssetCache()
+
+def build_mail_payload(to_list, cc_list, bcc_list, subject, html, inline_png_path: str | None = None,
+                       inline: list | None = None) -> dict:
     message = {
         "subject": subject,
         "body": {"contentType": "HTML", "content": html},
@@ -132,82 +1790,1498 @@ def send_mail_graph(to_list, cc_list, bcc_list, subject, html, inline_png_path:
         "bccRecipients": [{"emailAddress": {"address": x}} for x in bcc_list],
     }
 
-    # inline image opcional: cid:logo_tabisam
-    if inline_png_path and os.path.exists(inline_png_path):
-        with open(inline_png_path, "rb") as f:
-            content_bytes = f.read()
-        attachment = {
-            "@odata.type": "#microsoft.graph.fileAttachment",
-            "name": "image001.png",
-            "contentId": "logo_tabisam",
-            "isInline": True,
-            "contentBytes": base64.b64encode(content_bytes).decode("ascii"),
-            "contentType": "image/png",
-        }
-        message["attachments"] = [attachment]
+    # inline: adjuntos ya codificados de asset_cache; inline_png_path: el logo (cid:logo_tabisam)
+    adjuntos = list(inline or [])
+    if inline_png_path:
+        adjunto = asset_cache.attachment(InlineAsset(os.path.abspath(inline_png_path), "logo_tabisam", "image001.png", "image/png"))
+        if adjunto is not None:
+            adjuntos.append(adjunto)
+    if adjuntos:
+        message["attachments"] = adjuntos
 
-    payload = {"message": message, "saveToSentItems": True}
-    headers = {"Authorization": f"Bearer {token}"}
+    return {"message": message, "saveToSentItems": True}
 
-    r = requests.post(url, json=payload, headers=headers, timeout=30)
-    r.raise_for_status()
+def send_mail_graph(to_list, cc_list, bcc_list, subject, html, inline_png_path: str | None = None):
+    payload = build_mail_payload(to_list, cc_list, bcc_list, subject, html, inline_png_path)
+    graph_sendmail(payload)
 
-# --------- envio batch ---------
-def send_email_batch(rows) -> None:
-    cfg = load_email_config()
-    cc_emails = cfg.get("cc", [])
-    cco_emails = cfg.get("cco", [])
+def _retry_after(headers: dict | None) -> float:
+    for k, v in (headers or {}).items():
+        if k.lower() == "retry-after":
+            try:
+                return float(v)
+            except (TypeError, ValueError):
+                return 0.0
+    return 0.0
+
+def _sobre_transitorio(e: Exception) -> bool:
+    # 400/403 del sobre no se arreglan reintentando; graph_post ya agoto sus reintentos
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in GRAPH_RETRYABLE
+    return isinstance(e, GRAPH_RED_REINTENTABLE)
+
+def send_mail_graph_batch(payloads: list, ctl: DeliveryController | None = None) -> list:
+    """Envia payloads de sendMail agrupados en POST /$batch de hasta 20.
+
+    Devuelve una lista paralela a payloads: None si se envio o la excepcion
+    del subrequest. Solo se reintentan los subrequests con estado transitorio
+    (429/5xx o sin respuesta); el resto se da por fallido al primer intento.
+    """
+    ctl = ctl or DeliveryController()
+    resultados = [None] * len(payloads)
+    pendientes = list(range(len(payloads)))
+    intento = 0
+    while pendientes:
+        reintentar = []
+        espera = 0.0
+        for i in range(0, len(pendientes), GRAPH_BATCH_SIZE):
+            # cada subrequest sale del remitente que toque en este intento
+            asignados = {}
+            for idx in pendientes[i:i + GRAPH_BATCH_SIZE]:
+                try:
+                    asignados[idx] = remitentes.acquire(_num_destinatarios(payloads[idx]), ocupar=False)
+                except SenderQuotaError as e:
+                    resultados[idx] = e
+            grupo = list(asignados)
+            if not grupo:
+                continue
+            body = {"requests": [
+                {
+                    "id": str(idx),
+                    "method": "POST",
+                    "url": f"/users/{asignados[idx]}/sendMail",
+                    "headers": {"Content-Type": "application/json"},
+                    "body": payloads[idx],
+                }
+                for idx in grupo
+            ]}
+            try:
+                respuestas = {x.get("id"): x for x in graph_post(f"{GRAPH_URL}/$batch", body, ctl).json().get("responses", [])}
+            except CircuitOpenError as e:
+                # circuito abierto: no se intenta nada mas
+                for idx in grupo:
+                    remitentes.release(asignados[idx], ocupar=False)
+                for idx in pendientes[i:]:
+                    resultados[idx] = e
+                return resultados
+            except Exception as e:
+                # fallo del sobre completo: sus subrequests se reintentan solo si el error es transitorio
+                for idx in grupo:
+                    remitentes.release(asignados[idx], ocupar=False)
+                    resultados[idx] = e
+                if _sobre_transitorio(e):
+                    reintentar.extend(grupo)
+                continue
+            for idx in grupo:
+                sub = respuestas.get(str(idx))
+                status = sub.get("status", 0) if sub else 0
+                if 200 <= status < 300:
+                    remitentes.release(asignados[idx], _num_destinatarios(payloads[idx]), ocupar=False)
+                    resultados[idx] = None
+                    ctl.on_success()
+                    continue
+                remitentes.release(asignados[idx], ocupar=False)
+                error = ((sub or {}).get("body") or {}).get("error") or {}
+                resultados[idx] = GraphBatchError(status, error.get("message", "sin respuesta"))
+                if status == 0 or status in GRAPH_RETRYABLE:
+                    reintentar.append(idx)
+                    retry_after = _retry_after(sub.get("headers") if sub else None)
+                    if status in (429, 503) and remitentes.varios:
+                        # el buzon queda en pausa y el reintento sale por otro
+                        remitentes.on_throttle(asignados[idx], retry_after)
+                        if not _es_limitacion(status, retry_after):
+                            ctl.on_failure()
+                        continue
+                    espera = max(espera, retry_after)
+                    if status in (429, 503):
+                        ctl.on_throttle(retry_after)
+                    if not _es_limitacion(status, retry_after):
+                        ctl.on_failure()
+        remitentes.guardar_uso()
+        intento += 1
+        if not reintentar or intento > GRAPH_BATCH_RETRIES:
+            break
+        try:
+            ctl.wait(intento, espera)
+        except CircuitOpenError as e:
+            for idx in reintentar:
+                resultados[idx] = e
+            break
+        for idx in reintentar:
+            error = resultados[idx]
+            M_GRAPH_REINTENTOS.inc(endpoint="batch_sub", motivo=getattr(error, "status", "red") or "red")
+        pendientes = sorted(reintentar)
+    return resultados
+
+# --------- seguimiento de jobs ---------
+JOBS_KEEP = int(os.getenv("APPJ1_JOBS_KEEP", "20"))  # jobs que se guardan para /jobs/<id>
+JOBS_PERSIST_SECONDS = float(os.getenv("APPJ1_JOBS_PERSIST_SECONDS", "2"))  # cada cuanto se guarda el progreso en disco
+
+class JobStatus:
+    """Progreso de una ejecucion: fase, contadores y tiempos por etapa.
+
+    Los tiempos por etapa (query, render, send) son acumulados: con envio
+    en paralelo pueden sumar mas que el tiempo real transcurrido.
+    """
+
+    CONTADORES = ("fetched", "eligible", "sent", "queued", "failed", "skipped")
+
+    def __init__(self, job_id: str, engine: str = "", store: "JobStore | None" = None):
+        self.id = job_id
+        self.engine = engine
+        self._store = store
+        self._guardado = 0.0
+        self._lock = threading.Lock()
+        self.fase = "queued"
+        self.inicio = time.time()
+        self.fin = None
+        self.error = None
+        self.lectura_completa = False
+        self.contadores = dict.fromkeys(self.CONTADORES, 0)
+        self.tiempos = {}
+        self._inicio_fase = {}
+        self._inicio_envio = None
+        self._fin_envio = None
+
+    def phase(self, fase: str) -> None:
+        with self._lock:
+            if fase == self.fase:
+                return
+            self.fase = fase
+            self._inicio_fase.setdefault(fase, time.time())
+            if fase == "sending" and self._inicio_envio is None:
+                self._inicio_envio = time.monotonic()
+        self.persist(forzar=True)
+
+    def add(self, **contadores) -> None:
+        with self._lock:
+            for k, v in contadores.items():
+                self.contadores[k] += v
+        self.persist()
+
+    def persist(self, forzar: bool = False) -> None:
+        # el progreso se guarda en disco como mucho cada JOBS_PERSIST_SECONDS para otros procesos
+        if self._store is None:
+            return
+        ahora = time.monotonic()
+        if not forzar and ahora - self._guardado < JOBS_PERSIST_SECONDS:
+            return
+        self._guardado = ahora
+        self._store.guardar(self)
+
+    def timing(self, etapa: str, segundos: float) -> None:
+        with self._lock:
+            self.tiempos[etapa] = self.tiempos.get(etapa, 0.0) + segundos
+
+    @contextmanager
+    def medir(self, etapa: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(etapa, time.perf_counter() - t0)
+
+    def finish(self, error: str | None = None) -> None:
+        with self._lock:
+            self.fin = time.time()
+            self._fin_envio = time.monotonic()
+            self.error = error
+            self.fase = "error" if error else "done"
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            c = dict(self.contadores)
+            ritmo = None
+            eta = None
+            if self._inicio_envio is not None:
+                transcurrido = (self._fin_envio or time.monotonic()) - self._inicio_envio
+                if transcurrido > 0 and c["sent"] + c["queued"]:
+                    ritmo = (c["sent"] + c["queued"]) / transcurrido
+            if ritmo and self.lectura_completa and self.fin is None:
+                restantes = c["eligible"] - c["sent"] - c["queued"] - c["failed"] - c["skipped"]
+                eta = max(restantes, 0) / ritmo
+            return {
+                "job_id": self.id,
+                "engine": self.engine,
+                "pid": os.getpid(),
+                "phase": self.fase,
+                "started_at": datetime.fromtimestamp(self.inicio).isoformat(timespec="seconds"),
+                "finished_at": datetime.fromtimestamp(self.fin).isoformat(timespec="seconds") if self.fin else None,
+                "elapsed_s": round((self.fin or time.time()) - self.inicio, 3),
+                **c,
+                "throughput_per_s": round(ritmo, 3) if ritmo else None,
+                "eta_s": round(eta, 1) if eta is not None else None,
+                "phase_started_at": {k: datetime.fromtimestamp(v).isoformat(timespec="seconds") for k, v in self._inicio_fase.items()},
+                "timings_s": {k: round(v, 3) for k, v in self.tiempos.items()},
+                "error": self.error,
+            }
+
+class JobStore:
+    """Ultimos jobs (acotado) y el job en curso de este proceso.
 
-    hoy = weekday_today()
-    ayer = weekday_yesterday()
+    Los objetos JobStatus viven en memoria del proceso que ejecuta el job;
+    una foto de cada uno se guarda en DATA_DIR/jobs.db (al arrancar, en cada
+    cambio de fase, cada JOBS_PERSIST_SECONDS y al terminar). Asi /jobs/<id>
+    responde en cualquier worker, no solo en el que lanzo el job. La foto
+    lleva el pid del dueno; si ese proceso muere a medias, el job se queda
+    en su ultima fase guardada.
+    """
+
+    def __init__(self, keep: int = JOBS_KEEP, path: str | None = None):
+        self.keep = keep
+        self.path = path or os.path.join(DATA_DIR, "jobs.db")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._actual = None
+        self._suelto = JobStatus("")  # destino de las mediciones fuera de un job
+        self._listo = False
 
-    enviados = 0
-    for row in rows or []:
+    def _db(self):
+        if not self._listo:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with closing(sqlite3.connect(self.path, timeout=5)) as db, db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, inicio REAL NOT NULL, datos TEXT NOT NULL)")
+            self._listo = True
+        return closing(sqlite3.connect(self.path, timeout=5))
+
+    def guardar(self, job: JobStatus, podar: bool = False) -> None:
+        # un fallo del disco no puede parar el envio: se registra y sigue
         try:
-            dias_restantes = row[14]
-            debe_enviar = (
-                hoy != 6 and (
-                    dias_restantes in [31, 25, 20, 15]
-                    or dias_restantes < 13
-                    or (ayer == 6 and dias_restantes in [30, 24, 19, 14])
+            with self._db() as db, db:
+                db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (job.id, job.inicio, json.dumps(job.to_dict())))
+                if podar:
+                    db.execute("DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY inicio DESC LIMIT ?)", (self.keep,))
+        except Exception as e:
+            log(f"jobs: no se pudo guardar el estado de {job.id}: {e}", "warning")
+
+    def _guardados(self, job_id: str | None = None) -> list:
+        try:
+            with self._db() as db:
+                if job_id is None:
+                    filas = db.execute("SELECT datos FROM jobs ORDER BY inicio DESC LIMIT ?", (self.keep,)).fetchall()
+                else:
+                    filas = db.execute("SELECT datos FROM jobs WHERE id = ?", (job_id,)).fetchall()
+        except Exception as e:
+            log(f"jobs: no se pudo leer {self.path}: {e}", "warning")
+            return []
+        return [json.loads(f[0]) for f in filas]
+
+    def start(self, job_id: str, engine: str = "") -> JobStatus:
+        job = JobStatus(job_id, engine, store=self)
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.keep:
+                self._jobs.popitem(last=False)
+            self._actual = job
+        self.guardar(job, podar=True)
+        return job
+
+    def finish(self, job: JobStatus, error: str | None = None) -> None:
+        job.finish(error)
+        job.persist(forzar=True)
+        with self._lock:
+            if self._actual is job:
+                self._actual = None
+
+    def current(self) -> JobStatus:
+        # con single-flight hay como mucho un job en marcha por proceso
+        return self._actual or self._suelto
+
+    def get(self, job_id: str) -> JobStatus | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def recent(self) -> list:
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def snapshot(self, job_id: str) -> dict | None:
+        """Estado de un job de este proceso (en vivo) o de otro (ultima foto en disco)."""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        guardados = self._guardados(job_id)
+        return guardados[0] if guardados else None
+
+    def snapshots(self) -> list:
+        # los de este proceso en vivo; los de otros workers, desde disco
+        propios = {job.id: job.to_dict() for job in self.recent()}
+        todos = {d["job_id"]: d for d in self._guardados()}
+        todos.update(propios)
+        return sorted(todos.values(), key=lambda d: d["started_at"], reverse=True)[:self.keep]
+
+jobs = JobStore()
+
+class _JobEnLog(logging.Filter):
+    # cada linea de log lleva el id del job en curso
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job = jobs.current().id or None
+        return True
+
+logger.addFilter(_JobEnLog())
+
+# --------- registro de envios (ledger) ---------
+LEDGER_ENABLED = os.getenv("APPJ1_LEDGER", "1") == "1"
+
+class SentLedger:
+    """Registro persistente (SQLite) de los avisos ya enviados.
+
+    Clave (fecha, vehiculo, destinatario, umbral): un segundo disparo el mismo
+    dia o la reanudacion tras una caida solo envian lo que falta.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.path.join(DATA_DIR, "envios.db")
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conexion(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS envio (
+                    fecha TEXT NOT NULL,
+                    vehiculo TEXT NOT NULL,
+                    destinatario TEXT NOT NULL,
+                    umbral INTEGER NOT NULL,
+                    enviado_en TEXT NOT NULL,
+                    PRIMARY KEY (fecha, vehiculo, destinatario, umbral)
+                ) WITHOUT ROWID
+            """)
+            db.commit()
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def clave(row) -> tuple:
+        return row.matricula, (row.email or "").strip().lower(), row.dias_restantes
+
+    def enviados(self, fecha: str) -> set:
+        # una sola consulta por rango de la clave primaria en vez de una por fila
+        with self._lock:
+            filas = self._conexion().execute(
+                "SELECT vehiculo, destinatario, umbral FROM envio WHERE fecha = ?", (fecha,)
+            ).fetchall()
+        return set(filas)
+
+    def registrar(self, filas, fecha: str) -> None:
+        self.registrar_claves([self.clave(row) for row in filas], fecha)
+
+    def registrar_claves(self, claves, fecha: str) -> None:
+        ahora = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            db = self._conexion()
+            db.executemany(
+                "INSERT OR IGNORE INTO envio VALUES (?, ?, ?, ?, ?)",
+                [(fecha, *clave, ahora) for clave in claves],
+            )
+            db.commit()
+
+ledger = SentLedger()
+
+# --------- outbox persistente ---------
+OUTBOX_ENABLED = os.getenv("APPJ1_OUTBOX", "0") == "1"
+OUTBOX_WORKERS = int(os.getenv("APPJ1_OUTBOX_WORKERS", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("APPJ1_OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_SECONDS = 5.0
+# un mensaje 'enviando' solo se recupera si su reclamo tiene mas de esto: con varios procesos
+# (workers de wfastcgi, reciclado solapado de IIS) no se quita a otro proceso vivo lo que esta enviando.
+# Tiene que cubrir de sobra un $batch con todos sus reintentos.
+OUTBOX_LEASE_SECONDS = float(os.getenv("APPJ1_OUTBOX_LEASE_SECONDS", "900"))
+
+class Outbox:
+    """Cola en disco (SQLite) de correos ya renderizados.
+
+    Estados: pendiente -> enviando -> enviado | muerto. La clave unica evita
+    encolar dos veces el mismo aviso. Cada reclamo guarda el proceso y la
+    hora (reclamado_por, reclamado_en); lo que lleva 'enviando' mas de
+    OUTBOX_LEASE_SECONDS es de un proceso caido y vuelve a 'pendiente'.
+    """
+
+    def __init__(self, path: str | None = None, lease: float = OUTBOX_LEASE_SECONDS):
+        self.path = path or os.path.join(DATA_DIR, "outbox.db")
+        self.lease = lease
+        # pid mas un sufijo aleatorio: un pid reutilizado tras un reinicio no pasa por el mismo dueno
+        self.propietario = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conexion(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    clave TEXT NOT NULL UNIQUE,
+                    estado TEXT NOT NULL DEFAULT 'pendiente',
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    proximo REAL NOT NULL DEFAULT 0,
+                    creado TEXT NOT NULL,
+                    destino TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    ledger TEXT NOT NULL,
+                    error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS ix_outbox_estado ON outbox (estado, proximo);
+            """)
+            columnas = {c[1] for c in db.execute("PRAGMA table_info(outbox)")}
+            for columna, tipo in (("reclamado_por", "TEXT"), ("reclamado_en", "REAL")):
+                if columna not in columnas:
+                    # outbox.db creado por una version anterior
+                    db.execute(f"ALTER TABLE outbox ADD COLUMN {columna} {tipo}")
+            self._db = db
+        return self._db
+
+    def enqueue(self, items, fecha: str) -> int:
+        """items: lista de (filas, payload). Devuelve cuantos se han encolado de nuevo."""
+        ahora = datetime.now().isoformat(timespec="seconds")
+        registros = []
+        for filas, payload in items:
+            claves = [SentLedger.clave(row) for row in filas]
+            registros.append((
+                fecha + "|" + ";".join("|".join(map(str, c)) for c in claves),
+                ahora,
+                _destino(filas),
+                json.dumps(payload),
+                json.dumps([fecha, claves]),
+            ))
+        with self._lock:
+            db = self._conexion()
+            antes = db.total_changes
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT OR IGNORE INTO outbox (clave, creado, destino, payload, ledger) VALUES (?, ?, ?, ?, ?)",
+                    registros,
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            return db.total_changes - antes
+
+    def claim(self, n: int) -> list:
+        # BEGIN IMMEDIATE: dos workers (o dos procesos) no reclaman el mismo mensaje
+        with self._lock:
+            db = self._conexion()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                filas = db.execute(
+                    "SELECT id, intentos, destino, payload, ledger FROM outbox "
+                    "WHERE estado = 'pendiente' AND proximo <= ? ORDER BY id LIMIT ?",
+                    (time.time(), n),
+                ).fetchall()
+                db.executemany(
+                    "UPDATE outbox SET estado = 'enviando', reclamado_por = ?, reclamado_en = ? WHERE id = ?",
+                    [(self.propietario, time.time(), f[0]) for f in filas],
                 )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return filas
+
+    def _update(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._conexion().execute(sql, params)
+
+    def mark_sent(self, id_: int) -> None:
+        self._update("UPDATE outbox SET estado = 'enviado', error = NULL WHERE id = ?", (id_,))
+
+    def mark_retry(self, id_: int, error: str, delay: float, consume_attempt: bool = True) -> None:
+        self._update(
+            "UPDATE outbox SET estado = 'pendiente', intentos = intentos + ?, proximo = ?, error = ? WHERE id = ?",
+            (1 if consume_attempt else 0, time.time() + delay, error, id_),
+        )
+
+    def mark_dead(self, id_: int, error: str) -> None:
+        self._update("UPDATE outbox SET estado = 'muerto', intentos = intentos + 1, error = ? WHERE id = ?", (error, id_))
+
+    def recover(self) -> int:
+        """Devuelve a 'pendiente' los reclamos caducados (su proceso murio a medias)."""
+        with self._lock:
+            cur = self._conexion().execute(
+                "UPDATE outbox SET estado = 'pendiente', reclamado_por = NULL, reclamado_en = NULL "
+                "WHERE estado = 'enviando' AND (reclamado_en IS NULL OR reclamado_en < ?)",
+                (time.time() - self.lease,),
             )
-            if not debe_enviar:
+            return cur.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._conexion().execute("SELECT estado, COUNT(*) FROM outbox GROUP BY estado").fetchall())
+
+class OutboxDrainer:
+    """Hilos que vacian el outbox por $batch, con reintentos y dead-letter."""
+
+    def __init__(self, box: Outbox, workers: int = OUTBOX_WORKERS):
+        self.box = box
+        self.workers = workers
+        self._evento = threading.Event()
+        self._hilos = []
+
+    def start(self) -> None:
+        if self._hilos:
+            return
+        self.recover()
+        for i in range(self.workers):
+            hilo = Thread(target=self._loop, name=f"appj1_outbox_{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def wake(self) -> None:
+        self._evento.set()
+
+    def recover(self) -> None:
+        try:
+            recuperados = self.box.recover()
+        except Exception as e:
+            log(f"outbox: error recuperando reclamos caducados: {e}", "error")
+            return
+        if recuperados:
+            log(f"outbox: {recuperados} mensajes recuperados de reclamos caducados", recuperados=recuperados)
+
+    def _loop(self) -> None:
+        ctl = DeliveryController()
+        while True:
+            try:
+                items = self.box.claim(GRAPH_BATCH_SIZE)
+            except Exception as e:
+                log(f"outbox: error leyendo la cola: {e}", "error")
+                items = []
+            if not items:
+                # con la cola vacia se mira si otro proceso murio con mensajes reclamados
+                self.recover()
+                self._evento.wait(OUTBOX_POLL_SECONDS)
+                self._evento.clear()
                 continue
+            if ctl.open:
+                ctl = DeliveryController()
+            try:
+                self.drain(items, ctl)
+            except Exception as e:
+                log(f"outbox: error entregando lote: {e}", "error")
+                for id_, *_ in items:
+                    self.box.mark_retry(id_, str(e), GRAPH_BACKOFF_MAX, consume_attempt=False)
 
-            html = render_template(
-                "email_template.html",
-                conductor={"first_name": row[6]},
-                vehiculo={"name": row[0], "fecha_prxima_i_t_v": row[5]},
-            )
+    def drain(self, items, ctl: DeliveryController) -> None:
+        t0 = time.perf_counter()
+        errores = send_mail_graph_batch([json.loads(payload) for _, _, _, payload, _ in items], ctl)
+        duracion_ms = round((time.perf_counter() - t0) * 1000, 1)  # el $batch entero
+        for (id_, intentos, destino, _, ledger_json), error in zip(items, errores):
+            if error is None:
+                self.box.mark_sent(id_)
+                if LEDGER_ENABLED:
+                    fecha, claves = json.loads(ledger_json)
+                    ledger.registrar_claves([tuple(c) for c in claves], fecha)
+                log(f"correo enviado a {destino}", destino=destino, outbox_id=id_, duracion_ms=duracion_ms)
+            elif isinstance(error, CircuitOpenError):
+                # no es culpa del mensaje: vuelve a la cola sin gastar intento
+                self.box.mark_retry(id_, str(error), GRAPH_BACKOFF_MAX, consume_attempt=False)
+            elif (getattr(error, "status", 0) in GRAPH_RETRYABLE or not getattr(error, "status", 0)) \
+                    and intentos + 1 < OUTBOX_MAX_ATTEMPTS:
+                self.box.mark_retry(id_, str(error), min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** (intentos + 1)))
+            else:
+                self.box.mark_dead(id_, str(error))
+                log(f"outbox: descartado {destino} tras {intentos + 1} intentos: {error}", "error", destino=destino, outbox_id=id_, duracion_ms=duracion_ms)
 
-            send_mail_graph(
-                to_list=[row[13]],
-                cc_list=cc_emails,
-                bcc_list=cco_emails,
-                subject="Notificacion de Inspeccion Tecnica de Vehiculos",
-                html=html,
-                inline_png_path="static/image001.png",
-            )
-            enviados += 1
-            log(f"correo enviado a {row[13]}")
+outbox = Outbox()
+outbox_drainer = OutboxDrainer(outbox)
+
+# --------- envio batch ---------
+SEND_WORKERS = int(os.getenv("APPJ1_SEND_WORKERS", "1"))  # 1 = envio en serie (por defecto)
+SEND_MODE = os.getenv("APPJ1_SEND_MODE", "single")  # single: un sendMail por correo | batch: Graph $batch
+SEND_DIGEST = os.getenv("APPJ1_DIGEST", "0") == "1"  # un correo por conductor con todos sus vehiculos
+
+# --------- render de plantillas ---------
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+TEMPLATE_CACHE = os.getenv("APPJ1_TEMPLATE_CACHE", "1") == "1"  # bytecode de Jinja en DATA_DIR/jinja
+# variantes de templates/ que se usan para cada tipo de correo
+PLANTILLA_FILA = os.getenv("APPJ1_TEMPLATE", "email_template.html")
+PLANTILLA_DIGEST = os.getenv("APPJ1_TEMPLATE_DIGEST", "email_template_vehiculos.html")
+PLANTILLA_RESUMEN = os.getenv("APPJ1_TEMPLATE_RESUMEN", "email_template_responsables.html")
+
+class MailRenderer:
+    """Render de correos con un Environment de Jinja propio, sin Flask.
+
+    Cada plantilla se compila una vez por proceso y se guarda; con la cache
+    de bytecode el compilado sobrevive a los reinicios. Las plantillas
+    compiladas son seguras para renderizar desde varios hilos a la vez.
+    """
+
+    def __init__(self, path: str = TEMPLATES_DIR, cache_dir: str | None = os.path.join(DATA_DIR, "jinja") if TEMPLATE_CACHE else None):
+        bytecode_cache = None
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(cache_dir)
+            except OSError as e:
+                log(f"render: sin cache de bytecode en {cache_dir}: {e}", "warning")
+        self.env = Environment(
+            loader=FileSystemLoader(path),
+            autoescape=select_autoescape(["html", "htm", "xml"]),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+        )
+        self._lock = threading.Lock()
+        self._plantillas = {}
+        self._cids = {}
+
+    def template(self, nombre: str):
+        plantilla = self._plantillas.get(nombre)
+        if plantilla is None:
+            with self._lock:
+                plantilla = self._plantillas.get(nombre)
+                if plantilla is None:
+                    plantilla = self._plantillas[nombre] = self.env.get_template(nombre)
+        return plantilla
+
+    def precompile(self, nombres=None) -> int:
+        # compila por adelantado (por defecto todas las variantes de templates/)
+        nombres = nombres or self.env.list_templates(extensions=["html"])
+        for nombre in nombres:
+            self.template(nombre)
+        return len(nombres)
+
+    def render(self, nombre: str, **contexto) -> str:
+        plantilla = self.template(nombre)
+        with M_RENDER_SEGUNDOS.time(plantilla=nombre):
+            return plantilla.render(**contexto)
+
+    def render_many(self, nombre: str, contextos) -> list:
+        """Muchas filas con la misma plantilla: una sola busqueda de la plantilla.
+
+        Devuelve una lista paralela a contextos con el HTML o la excepcion de
+        esa fila (un contexto roto no tira el lote). Una muestra de la metrica
+        por fila, como render.
+        """
+        plantilla = self.template(nombre)
+        salida = []
+        for c in contextos:
+            t0 = time.perf_counter()
+            try:
+                salida.append(plantilla.render(**c))
+            except Exception as e:
+                salida.append(e)
+            M_RENDER_SEGUNDOS.observe(time.perf_counter() - t0, plantilla=nombre)
+        return salida
+
+    def content_ids(self, nombre: str) -> tuple:
+        # cid: que referencia la plantilla (se mira el fuente una vez)
+        cids = self._cids.get(nombre)
+        if cids is None:
+            fuente = self.env.loader.get_source(self.env, nombre)[0]
+            cids = self._cids[nombre] = tuple(dict.fromkeys(re.findall(r'cid:([\w.@-]+)', fuente)))
+        return cids
+
+    def reload(self) -> None:
+        # tras editar una plantilla en caliente
+        with self._lock:
+            self._plantillas.clear()
+            self._cids.clear()
+            if self.env.cache is not None:
+                self.env.cache.clear()
+
+renderer = MailRenderer()
+
+def _render(plantilla: str, **contexto) -> str:
+    return renderer.render(plantilla, **contexto)
+
+def _contexto_fila(row) -> dict:
+    return {
+        "conductor": {"first_name": row.first_name},
+        "vehiculo": {"name": row.matricula, "fecha_prxima_i_t_v": row.fecha_prxima_i_t_v},
+    }
+
+def adjuntos_de(plantilla: str) -> list:
+    """Adjuntos inline (de asset_cache) para los cid: que usa la plantilla."""
+    return asset_cache.attachments(renderer.content_ids(plantilla))
+
+def render_filas(rows, plantilla: str = PLANTILLA_FILA) -> list:
+    """HTML de un aviso por fila renderizado en lote (mismo orden que rows; la excepcion si esa fila falla)."""
+    return renderer.render_many(plantilla, (_contexto_fila(row) for row in rows))
+
+def payload_fila(row, cc_emails, cco_emails, html: str | None = None) -> dict:
+    if html is None:
+        html = _render(PLANTILLA_FILA, **_contexto_fila(row))
+
+    return build_mail_payload(
+        to_list=[row.email],
+        cc_list=cc_emails,
+        bcc_list=cco_emails,
+        subject="Notificacion de Inspeccion Tecnica de Vehiculos",
+        html=html,
+        inline=adjuntos_de(PLANTILLA_FILA),
+    )
+
+def payload_digest(filas, cc_emails, cco_emails) -> dict:
+    html = _render(
+        PLANTILLA_DIGEST,
+        conductor={"first_name": filas[0].first_name},
+        vehiculos=[{"name": row.matricula, "fecha_prxima_i_t_v": row.fecha_prxima_i_t_v, "dias_restantes": row.dias_restantes} for row in filas],
+    )
+    return build_mail_payload(
+        to_list=[filas[0].email],
+        cc_list=cc_emails,
+        bcc_list=cco_emails,
+        subject="Notificacion de Inspeccion Tecnica de Vehiculos",
+        html=html,
+        inline=adjuntos_de(PLANTILLA_DIGEST),
+    )
+
+def payload_envio(filas, cc_emails, cco_emails) -> dict:
+    with jobs.current().medir("render"):
+        # un envio es una lista de filas del mismo destinatario (digest) o una sola fila
+        if len(filas) == 1:
+            return payload_fila(filas[0], cc_emails, cco_emails)
+        return payload_digest(filas, cc_emails, cco_emails)
+
+def payloads_envio(envios, cc_emails, cco_emails) -> list:
+    """payload_envio para un lote de envios; las filas sueltas se renderizan en bloque.
+
+    Devuelve una lista paralela a envios con el payload o la excepcion del render.
+    """
+    with jobs.current().medir("render"):
+        sueltos = [i for i, filas in enumerate(envios) if len(filas) == 1]
+        htmls = dict(zip(sueltos, render_filas([envios[i][0] for i in sueltos])))
+        salida = []
+        for i, filas in enumerate(envios):
+            try:
+                if i not in htmls:
+                    salida.append(payload_digest(filas, cc_emails, cco_emails))
+                elif isinstance(htmls[i], Exception):
+                    salida.append(htmls[i])
+                else:
+                    salida.append(payload_fila(filas[0], cc_emails, cco_emails, html=htmls[i]))
+            except Exception as e:
+                salida.append(e)
+        return salida
+
+def agrupar_envios(rows, digest: bool):
+    # sin digest cada fila es un envio y se procesa segun llega (sirve con el cursor en streaming)
+    if not digest:
+        return ([row] for row in rows)
+    # digest: un correo por direccion (email) con todos sus vehiculos, en orden de aparicion
+    grupos = {}
+    for row in rows:
+        grupos.setdefault((row.email or "").strip().lower(), []).append(row)
+    return list(grupos.values())
+
+def _destino(filas) -> str:
+    return filas[0].email if len(filas) == 1 else f"{filas[0].email} ({len(filas)} vehiculos)"
+
+def _campos_envio(filas, segundos: float | None = None) -> dict:
+    # campos estructurados de un envio para el log; segundos: lo que tardo Graph (en un $batch, el lote entero)
+    campos = {"destino": filas[0].email, "matriculas": [row.matricula for row in filas]}
+    if segundos is not None:
+        campos["duracion_ms"] = round(segundos * 1000, 1)
+    return campos
+
+ENCOLADO = "encolado"  # estado de resultados en modo outbox: lo entregan los drain workers despues
+
+def enviar_resumen_responsables(resultados, cc_emails, cco_emails, ctl: DeliveryController | None = None) -> bool:
+    """Envia a cc/cco un unico correo con todos los avisos de la ejecucion.
+
+    resultados: lista de (filas, enviado), enviado True, False o ENCOLADO.
+    Se agrupa por centro de trabajo.
+    """
+    if not resultados or not (cc_emails or cco_emails):
+        return False
+    centros = {}
+    for filas, enviado in resultados:
+        for row in filas:
+            centros.setdefault(row.centro_de_trabajo or "Sin centro", []).append({
+                "name": row.matricula,
+                "fecha_prxima_i_t_v": row.fecha_prxima_i_t_v,
+                "first_name": row.first_name,
+                "email": row.email,
+                "dias_restantes": row.dias_restantes,
+                "enviado": enviado is True,
+                "encolado": enviado == ENCOLADO,
+            })
+    html = _render(
+        PLANTILLA_RESUMEN,
+        fecha=datetime.now().strftime("%d/%m/%Y"),
+        centros=[{"nombre": k, "vehiculos": centros[k]} for k in sorted(centros)],
+    )
+    payload = build_mail_payload(
+        to_list=cc_emails,
+        cc_list=[],
+        bcc_list=cco_emails,
+        subject="Resumen de notificaciones de Inspeccion Tecnica de Vehiculos",
+        html=html,
+        inline=adjuntos_de(PLANTILLA_RESUMEN),
+    )
+    try:
+        graph_sendmail(payload, ctl)
+    except Exception as e:
+        log(f"error enviando resumen a responsables: {e}", "error")
+        return False
+    log(f"resumen enviado a responsables ({len(cc_emails) + len(cco_emails)} destinatarios, {len(resultados)} avisos)")
+    return True
+
+def enviar_envio(filas, cc_emails, cco_emails, ctl: DeliveryController | None = None) -> None:
+    payload = payload_envio(filas, cc_emails, cco_emails)
+    with jobs.current().medir("send"):
+        graph_sendmail(payload, ctl)
+
+def _envio_medido(filas, cc_emails, cco_emails, ctl: DeliveryController | None = None) -> tuple:
+    # (segundos, error): el tiempo se anota tambien cuando el envio falla
+    t0 = time.perf_counter()
+    try:
+        enviar_envio(filas, cc_emails, cco_emails, ctl)
+        return time.perf_counter() - t0, None
+    except Exception as e:
+        return time.perf_counter() - t0, e
+
+def send_email_batch(rows, workers: int | None = None, mode: str | None = None, digest: bool | None = None,
+                     politica: tuple | None = None) -> int:
+    """Envia los avisos de rows (lista o iterador de FilaITV) y devuelve los enviados.
+
+    Con outbox devuelve los encolados: la entrega la hacen los drain workers.
+    """
+    res, _ = _send_email_batch(rows, workers, mode, digest, politica)
+    return res["enviados"] + res["encolados"]
+
+def _send_email_batch(rows, workers: int | None = None, mode: str | None = None, digest: bool | None = None,
+                      politica: tuple | None = None, resumen: bool = True) -> tuple:
+    """Envia los avisos de rows (lista o iterador de FilaITV); devuelve (res, resultados).
+
+    Con un iterador (cursor en streaming) las filas se envian segun llegan,
+    salvo en modo digest, que necesita todas las de cada destinatario.
+    """
+    cfg = load_email_config()
+    cc_resumen = cfg.get("cc_resumen", False)
+    # en modo resumen los correos a conductores salen sin copia
+    cc_emails = [] if cc_resumen else cfg.get("cc", [])
+    cco_emails = [] if cc_resumen else cfg.get("cco", [])
+
+    politica = politica_del_dia() if politica is None else politica
+    workers = SEND_WORKERS if workers is None else workers
+    mode = mode or SEND_MODE
+    digest = SEND_DIGEST if digest is None else digest
+    ctl = DeliveryController(max_limit=workers)
+    if mode != "batch" and not OUTBOX_ENABLED:
+        remitentes.avisar_tope("envio", workers)
+
+    res = {"filas": 0, "enviados": 0, "errores": 0, "sin_enviar": 0, "omitidos": 0, "encolados": 0}
+    resultados = []  # (filas, enviado) para el resumen de responsables
+    fecha = datetime.now().date().isoformat()
+    ya_enviados = ledger.enviados(fecha) if LEDGER_ENABLED else set()
+    job = jobs.current()
+    job.phase("rendering")
+
+    error_lectura = []  # error del cursor en streaming: se relanza al terminar lo ya leido
+
+    def elegibles():
+        try:
+            for row in rows or ():
+                res["filas"] += 1
+                job.add(fetched=1)
+                if not debe_enviar(row.dias_restantes, politica):
+                    continue
+                job.add(eligible=1)
+                if ledger.clave(row) in ya_enviados:
+                    res["omitidos"] += 1
+                    job.add(skipped=1)
+                    continue
+                yield row
+        except Exception as e:
+            # los envios en curso terminan y quedan en el ledger antes de relanzar
+            error_lectura.append(e)
+            return
+        job.lectura_completa = True
+
+    def anotar(filas, error: Exception | None = None, segundos: float | None = None):
+        # solo se llama desde este hilo: contadores y log sin locks
+        resultados.append((filas, error is None))
+        job.add(**{"sent" if error is None else "skipped" if isinstance(error, CircuitOpenError) else "failed": len(filas)})
+        if error is None:
+            res["enviados"] += 1
+            if LEDGER_ENABLED:
+                ledger.registrar(filas, fecha)
+            log(f"correo enviado a {_destino(filas)}", **_campos_envio(filas, segundos))
+        elif isinstance(error, CircuitOpenError):
+            res["sin_enviar"] += 1
+        else:
+            res["errores"] += 1
+            log(f"error enviando a {_destino(filas)}: {error}", "error", **_campos_envio(filas, segundos))
+
+    pendientes = agrupar_envios(elegibles(), digest)
+    if OUTBOX_ENABLED:
+        # se encola ya renderizado; los drain workers hacen la entrega
+        lote = []  # envios pendientes de render; se renderizan en bloque
+
+        def encolar():
+            job.phase("sending")
+            listos = []
+            for filas, payload in zip(lote, payloads_envio(lote, cc_emails, cco_emails)):
+                if isinstance(payload, Exception):
+                    anotar(filas, payload)
+                else:
+                    listos.append((filas, payload))
+            nuevos = outbox.enqueue(listos, fecha)
+            for filas, _ in listos:
+                # aun no se ha entregado: en el resumen sale como encolado, no como enviado
+                resultados.append((filas, ENCOLADO))
+                job.add(queued=len(filas))
+                log(f"correo encolado para {_destino(filas)}", **_campos_envio(filas))
+            res["encolados"] += nuevos
+            lote.clear()
+            outbox_drainer.wake()
+
+        for filas in pendientes:
+            lote.append(filas)
+            if len(lote) >= 100:
+                encolar()
+        if lote:
+            encolar()
+    elif mode == "batch":
+        lote = []  # envios pendientes de render; se renderizan en bloque
+
+        def enviar_lote():
+            job.phase("sending")
+            listos = []
+            for filas, payload in zip(lote, payloads_envio(lote, cc_emails, cco_emails)):
+                if isinstance(payload, Exception):
+                    anotar(filas, payload)
+                else:
+                    listos.append((filas, payload))
+            lote.clear()
+            if not listos:
+                return
+            t0 = time.perf_counter()
+            with job.medir("send"):
+                errores = send_mail_graph_batch([p for _, p in listos], ctl)
+            segundos = time.perf_counter() - t0
+            for (filas, _), error in zip(listos, errores):
+                anotar(filas, error, segundos)
+
+        for filas in pendientes:
+            lote.append(filas)
+            if len(lote) >= GRAPH_BATCH_SIZE:
+                enviar_lote()
+        if lote:
+            enviar_lote()
+    elif workers <= 1:
+        for filas in pendientes:
+            if ctl.open:
+                # circuito abierto: se agota la entrada solo para contar lo que queda sin enviar
+                anotar(filas, CircuitOpenError())
+                continue
+            job.phase("sending")
+            segundos, error = _envio_medido(filas, cc_emails, cco_emails, ctl)
+            anotar(filas, error, segundos)
+    else:
+        # pool acotado con ventana deslizante: como mucho 2*workers envios encolados,
+        # los resultados se recogen en el orden de las filas y solo este hilo toca contadores y log
+        ventana = deque()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="appj1_envio") as pool:
+            for filas in pendientes:
+                job.phase("sending")
+                ventana.append((filas, pool.submit(_envio_medido, filas, cc_emails, cco_emails, ctl)))
+                if len(ventana) >= 2 * workers:
+                    filas_hecho, futuro = ventana.popleft()
+                    segundos, error = futuro.result()
+                    anotar(filas_hecho, error, segundos)
+            while ventana:
+                filas_hecho, futuro = ventana.popleft()
+                segundos, error = futuro.result()
+                anotar(filas_hecho, error, segundos)
+
+    remitentes.guardar_uso(forzar=True)
+    if ctl.open:
+        log(f"envio detenido: circuito abierto, sin enviar={res['sin_enviar']}", "warning")
+    if error_lectura:
+        # lectura incompleta: sin resumen de responsables y el job termina con error
+        log(f"envio incompleto: lectura de DB cortada tras {res['filas']} filas, enviados={res['enviados']}", "error", **res)
+        raise error_lectura[0]
+    if cc_resumen and resumen:
+        enviar_resumen_responsables(resultados, cfg.get("cc", []), cfg.get("cco", []))
+    log(f"control de entrega: {ctl.stats()}", **ctl.stats())
+    log(f"envio finalizado. filas={res['filas']} enviados={res['enviados']} errores={res['errores']} ya_enviados={res['omitidos']}", **res)
+    if OUTBOX_ENABLED:
+        log(f"outbox: encolados={res['encolados']} estado={outbox.stats()}")
+    log(f"conexiones graph: {graph_http.stats()}", **graph_http.stats())
+    if remitentes.varios:
+        log(f"remitentes: {remitentes.stats()}", remitentes=remitentes.stats())
+    return res, resultados
+
+# --------- motor asyncio ---------
+ASYNC_CONCURRENCY = int(os.getenv("APPJ1_ASYNC_CONCURRENCY", "50"))
+ASYNC_QUEUE_SIZE = 500  # cola acotada entre etapas (contrapresion)
+
+async def _token_async() -> str:
+    # el token cacheado se lee sin bloquear; solo la renovacion va a un hilo
+    return token_provider.cached() or await asyncio.to_thread(graph_token)
+
+class AsyncDeliveryController(DeliveryController):
+    """DeliveryController para el motor asyncio: mismo AIMD, pausa y breaker.
+
+    acquire y wait son corutinas; quien espera turno queda en un future del
+    loop, sin hilos bloqueados. Solo se usa desde el hilo del event loop.
+    """
+
+    def __init__(self, max_limit: int = 1, breaker_threshold: int = BREAKER_THRESHOLD):
+        super().__init__(max_limit, breaker_threshold)
+        self._esperando = deque()
+
+    def _despertar(self, todos: bool = False) -> None:
+        while self._esperando:
+            fut = self._esperando.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                if not todos:
+                    return
+
+    async def acquire(self) -> None:
+        while not self.open and self._in_flight >= self.limit:
+            fut = asyncio.get_running_loop().create_future()
+            self._esperando.append(fut)
+            await fut
+        if self.open:
+            raise self._circuito_abierto()
+        self._in_flight += 1
+        pausa = self._pause_until - time.monotonic()
+        if pausa > 0:
+            await asyncio.sleep(pausa)
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._despertar()
+
+    def on_success(self) -> None:
+        limite = self.limit
+        super().on_success()
+        if self.limit > limite:
+            self._despertar()
+
+    def on_failure(self) -> None:
+        super().on_failure()
+        if self.open:
+            # los que esperan turno salen con CircuitOpenError
+            self._despertar(todos=True)
+
+    async def wait(self, intento: int, retry_after: float = 0.0) -> None:
+        await asyncio.sleep(self._espera(intento, retry_after))
+
+async def graph_post_async(client: httpx.AsyncClient, url: str, payload: dict,
+                           ctl: AsyncDeliveryController | None = None,
+                           shift_throttle: bool = False) -> httpx.Response:
+    # mismo criterio que graph_post, con el controlador asyncio
+    ctl = ctl or AsyncDeliveryController()
+    intento = 0
+    while True:
+        token = await _token_async()
+        await ctl.acquire()
+        t0 = time.perf_counter()
+        try:
+            r = await client.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+        except httpx.TransportError as e:
+            M_GRAPH_SEGUNDOS.observe(time.perf_counter() - t0, endpoint=_endpoint(url), status="error")
+            ctl.on_failure()
+            if intento >= GRAPH_MAX_RETRIES or not isinstance(e, GRAPH_RED_REINTENTABLE):
+                raise
+            r = None
+        else:
+            M_GRAPH_SEGUNDOS.observe(time.perf_counter() - t0, endpoint=_endpoint(url), status=r.status_code)
+        finally:
+            ctl.release()
+        if r is None:
+            M_GRAPH_REINTENTOS.inc(endpoint=_endpoint(url), motivo="red")
+            await ctl.wait(intento)
+            intento += 1
+            continue
+        if r.status_code == 401 and intento == 0:
+            # token revocado o caducado antes de tiempo: renovar una vez
+            token_provider.invalidate(token)
+            intento += 1
+            continue
+        if r.status_code in GRAPH_RETRYABLE:
+            retry_after = _retry_after(r.headers)
+            if shift_throttle and r.status_code in (429, 503):
+                raise MailboxThrottled(r.status_code, retry_after)
+            if r.status_code in (429, 503):
+                ctl.on_throttle(retry_after)
+            if not _es_limitacion(r.status_code, retry_after):
+                ctl.on_failure()
+            if intento >= GRAPH_MAX_RETRIES:
+                r.raise_for_status()
+            M_GRAPH_REINTENTOS.inc(endpoint=_endpoint(url), motivo=r.status_code)
+            await ctl.wait(intento, retry_after)
+            intento += 1
+            continue
+        if r.status_code in (401, 403):
+            ctl.on_failure()
+        r.raise_for_status()
+        ctl.on_success()
+        return r
+
+async def graph_sendmail_async(client: httpx.AsyncClient, payload: dict,
+                               ctl: AsyncDeliveryController | None = None) -> httpx.Response:
+    # como graph_sendmail: reparte entre remitentes y pasa a otro buzon si uno responde 429/503
+    n = _num_destinatarios(payload)
+    cambios = 0
+    while True:
+        upn = await remitentes.acquire_async(n)
+        ok = False
+        try:
+            r = await graph_post_async(client, f"{GRAPH_URL}/users/{upn}/sendMail", payload, ctl,
+                                       shift_throttle=remitentes.varios)
+            ok = True
+            return r
+        except MailboxThrottled as e:
+            remitentes.on_throttle(upn, e.retry_after)
+            if ctl is not None and not _es_limitacion(e.status, e.retry_after):
+                ctl.on_failure()
+            cambios += 1
+            if cambios > GRAPH_MAX_RETRIES:
+                raise
+        finally:
+            remitentes.release(upn, n if ok else 0)
+        if remitentes.uso_pendiente():
+            # la escritura en SQLite va a un hilo para no parar el bucle
+            await asyncio.to_thread(remitentes.guardar_uso)
+
+async def send_email_pipeline(concurrency: int | None = None, digest: bool | None = None,
+                              politica: tuple | None = None) -> dict:
+    """Motor alternativo: consulta -> politica -> render -> envio, en etapas asyncio.
+
+    Las etapas se comunican por colas acotadas; el envio usa un unico
+    httpx.AsyncClient, un semaforo limita las tareas de envio y un
+    AsyncDeliveryController las peticiones en vuelo (AIMD y breaker).
+    """
+    cfg = load_email_config()
+    cc_resumen = cfg.get("cc_resumen", False)
+    cc_emails = [] if cc_resumen else cfg.get("cc", [])
+    cco_emails = [] if cc_resumen else cfg.get("cco", [])
+    politica = politica_del_dia() if politica is None else politica
+    digest = SEND_DIGEST if digest is None else digest
+    sem = asyncio.Semaphore(concurrency or ASYNC_CONCURRENCY)
+    ctl = AsyncDeliveryController(max_limit=concurrency or ASYNC_CONCURRENCY)
+    remitentes.avisar_tope("pipeline", concurrency or ASYNC_CONCURRENCY)
+    q_filas = asyncio.Queue(ASYNC_QUEUE_SIZE)
+    q_render = asyncio.Queue(ASYNC_QUEUE_SIZE)
+    q_envio = asyncio.Queue(ASYNC_QUEUE_SIZE)
+    res = {"filas": 0, "enviados": 0, "errores": 0, "sin_enviar": 0, "omitidos": 0}
+    fecha = datetime.now().date().isoformat()
+    ya_enviados = ledger.enviados(fecha) if LEDGER_ENABLED else set()
+    job = jobs.current()
+    resultados = []  # (filas, enviado) para el resumen de responsables
+    error_lectura = []  # error del cursor en streaming: se relanza al terminar lo ya leido
+
+    async def consultar():
+        job.phase("querying")
+        if DB_STREAM:
+            # el cursor de servidor se lee en un hilo; la cola acotada frena la lectura
+            loop = asyncio.get_running_loop()
+
+            def producir():
+                for row in iter_data_from_db(politica):
+                    asyncio.run_coroutine_threadsafe(q_filas.put(row), loop).result()
+
+            try:
+                await asyncio.to_thread(producir)
+            except Exception as e:
+                # las etapas siguientes terminan con lo ya leido
+                error_lectura.append(e)
+        else:
+            with job.medir("query"):
+                rows = await asyncio.to_thread(get_data_from_db, politica)
+            if rows is None:
+                error_lectura.append(DBReadError())
+            for row in rows or []:
+                await q_filas.put(row)
+        await q_filas.put(None)
+
+    async def filtrar():
+        elegibles = []
+        while (row := await q_filas.get()) is not None:
+            res["filas"] += 1
+            job.add(fetched=1)
+            if not debe_enviar(row.dias_restantes, politica):
+                continue
+            job.add(eligible=1)
+            if ledger.clave(row) in ya_enviados:
+                res["omitidos"] += 1
+                job.add(skipped=1)
+                continue
+            if digest:
+                # el digest necesita todas las filas del destinatario antes de renderizar
+                elegibles.append(row)
+            else:
+                await q_render.put([row])
+        job.lectura_completa = not error_lectura
+        for filas in agrupar_envios(elegibles, digest):
+            await q_render.put(filas)
+        await q_render.put(None)
+
+    async def renderizar():
+        while (filas := await q_render.get()) is not None:
+            try:
+                payload = payload_envio(filas, cc_emails, cco_emails)
+            except Exception as e:
+                res["errores"] += 1
+                job.add(failed=len(filas))
+                resultados.append((filas, False))
+                log(f"error enviando a {_destino(filas)}: {e}", "error", **_campos_envio(filas))
+                continue
+            await q_envio.put((filas, payload))
+        await q_envio.put(None)
+
+    async def enviar_uno(client, filas, payload):
+        job.phase("sending")
+        t0 = time.perf_counter()
+        try:
+            if ctl.open:
+                # circuito abierto: se agota la entrada solo para contar lo que queda sin enviar
+                raise CircuitOpenError()
+            with job.medir("send"):
+                await graph_sendmail_async(client, payload, ctl)
+            res["enviados"] += 1
+            job.add(sent=len(filas))
+            resultados.append((filas, True))
+            if LEDGER_ENABLED:
+                ledger.registrar(filas, fecha)
+            log(f"correo enviado a {_destino(filas)}", **_campos_envio(filas, time.perf_counter() - t0))
+        except CircuitOpenError:
+            res["sin_enviar"] += 1
+            job.add(skipped=len(filas))
+            resultados.append((filas, False))
         except Exception as e:
-            log(f"error enviando a {row[13]}: {e}")
+            res["errores"] += 1
+            job.add(failed=len(filas))
+            resultados.append((filas, False))
+            log(f"error enviando a {_destino(filas)}: {e}", "error", **_campos_envio(filas, time.perf_counter() - t0))
+        finally:
+            sem.release()
 
-    log(f"envio finalizado. enviados={enviados}")
+    async def enviar():
+        async with httpx.AsyncClient(http2=graph_http.http2_efectivo, limits=graph_http.limits, timeout=graph_http.timeout) as client:
+            tareas = set()
+            while (item := await q_envio.get()) is not None:
+                await sem.acquire()
+                tarea = asyncio.create_task(enviar_uno(client, *item))
+                tareas.add(tarea)
+                tarea.add_done_callback(tareas.discard)
+            if tareas:
+                await asyncio.gather(*tareas)
+
+    await asyncio.gather(consultar(), filtrar(), renderizar(), enviar())
+    await asyncio.to_thread(remitentes.guardar_uso, True)
+    if ctl.open:
+        log(f"envio detenido: circuito abierto, sin enviar={res['sin_enviar']}", "warning")
+    if error_lectura:
+        log(f"envio incompleto: lectura de DB cortada tras {res['filas']} filas, enviados={res['enviados']}", "error", **res)
+        raise error_lectura[0]
+    if cc_resumen:
+        await asyncio.to_thread(enviar_resumen_responsables, resultados, cfg.get("cc", []), cfg.get("cco", []))
+    log(f"control de entrega: {ctl.stats()}", **ctl.stats())
+    log(f"envio finalizado. filas={res['filas']} enviados={res['enviados']} errores={res['errores']} ya_enviados={res['omitidos']}", **res)
+    return res
+
+# --------- ejecucion por shards (multiproceso) ---------
+SHARD_PROCESSES = int(os.getenv("APPJ1_SHARDS", str(os.cpu_count() or 2)))
+SHARD_KEY = os.getenv("APPJ1_SHARD_KEY", "centro")  # centro | destinatario
+
+def repartir_shards(rows, n: int, clave: str = SHARD_KEY) -> list:
+    """Reparte rows en como mucho n shards (sin shards vacios).
+
+    centro: cada centro de trabajo va entero a un shard, los mas grandes
+    primero al shard con menos filas. destinatario: hash estable del email,
+    asi un digest nunca se parte entre procesos.
+    """
+    shards = [[] for _ in range(max(1, n))]
+    if clave == "destinatario":
+        for row in rows:
+            h = int(hashlib.sha1((row.email or "").strip().lower().encode("utf-8")).hexdigest()[:8], 16)
+            shards[h % len(shards)].append(row)
+    else:
+        centros = {}
+        for row in rows:
+            centros.setdefault(row.centro_de_trabajo or "", []).append(row)
+        for grupo in sorted(centros.values(), key=len, reverse=True):
+            min(shards, key=len).extend(grupo)
+    return [shard for shard in shards if shard]
+
+def _shard_init(n_shards: int) -> None:
+    # el proceso arranca con spawn: cliente HTTP, pool de DB, token y ledger son suyos al importar el modulo.
+    # el ritmo y la concurrencia por buzon se reparten para no pasar el limite entre todos los shards
+    # (send_email_sharded no lanza mas shards que SENDER_CONCURRENCY: a cada uno le toca al menos 1)
+    remitentes.per_minute = SENDER_PER_MINUTE / n_shards
+    remitentes.concurrency = max(1, SENDER_CONCURRENCY // n_shards) if SENDER_CONCURRENCY else 0
+
+def _shard_worker(shard: int, job_id: str, filas: list, politica: tuple) -> dict:
+    job = jobs.start(f"{job_id}-{shard}", "shard")
+    try:
+        res, resultados = _send_email_batch(filas, politica=politica, resumen=False)
+    finally:
+        jobs.finish(job)
+    return {"res": res, "resultados": resultados, "progreso": dict(job.contadores), "tiempos": dict(job.tiempos)}
+
+def send_email_sharded(rows, politica: tuple | None = None, procesos: int | None = None,
+                       clave: str | None = None) -> dict:
+    """Coordinador: filtra, reparte las filas elegibles en shards y envia cada uno en un proceso.
+
+    Cada shard es un send_email_batch completo (ledger, modos, digest) en su
+    proceso; aqui se juntan contadores y resultados y se manda el resumen
+    de responsables una sola vez.
+    """
+    politica = politica_del_dia() if politica is None else politica
+    procesos = procesos or SHARD_PROCESSES
+    if SENDER_CONCURRENCY and procesos > SENDER_CONCURRENCY:
+        # cada shard necesita al menos una peticion en vuelo por buzon: mas shards pasarian del limite
+        log(f"shards limitados a {SENDER_CONCURRENCY} por APPJ1_SENDER_CONCURRENCY (pedidos {procesos})", "warning")
+        procesos = SENDER_CONCURRENCY
+    job = jobs.current()
+    rows = list(rows or ())
+    job.add(fetched=len(rows))
+    shards = repartir_shards([row for row in rows if debe_enviar(row.dias_restantes, politica)], procesos, clave or SHARD_KEY)
+    job.lectura_completa = True
+    total = {"filas": len(rows), "enviados": 0, "errores": 0, "sin_enviar": 0, "omitidos": 0, "encolados": 0}
+    resultados = []
+    if shards:
+        job.phase("sending")
+        log(f"envio en {len(shards)} shards por {clave or SHARD_KEY}: {[len(x) for x in shards]} filas")
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_shard_init, initargs=(len(shards),)) as pool:
+            futuros = {pool.submit(_shard_worker, i, job.id, filas, politica): (i, filas) for i, filas in enumerate(shards)}
+            for futuro in as_completed(futuros):
+                i, filas = futuros[futuro]
+                try:
+                    r = futuro.result()
+                except Exception as e:
+                    # lo que llegara a enviar ese shard ya esta en el ledger; el resto cuenta como error
+                    total["errores"] += len(filas)
+                    job.add(eligible=len(filas), failed=len(filas))
+                    resultados.extend(([row], False) for row in filas)
+                    log(f"shard {i} fallido ({len(filas)} filas): {e}", "error", shard=i)
+                    continue
+                for k, v in r["res"].items():
+                    if k != "filas":
+                        total[k] += v
+                resultados.extend(r["resultados"])
+                job.add(**{k: v for k, v in r["progreso"].items() if k != "fetched"})
+                for etapa, segundos in r["tiempos"].items():
+                    job.timing(etapa, segundos)
+                log(f"shard {i} terminado: {r['res']}", shard=i, **r["res"])
+    cfg = load_email_config()
+    if cfg.get("cc_resumen", False):
+        enviar_resumen_responsables(resultados, cfg.get("cc", []), cfg.get("cco", []))
+    log(f"envio finalizado. filas={total['filas']} enviados={total['enviados']} errores={total['errores']} ya_enviados={total['omitidos']}", shards=len(shards), **total)
+    return total
+
+# --------- ejecucion unica (single-flight) ---------
+class JobLock:
+    """Garantiza un solo job a la vez, entre hilos y entre procesos worker.
+
+    En el proceso: un unico threading.Lock de modulo (no uno nuevo por llamada).
+    Entre procesos: lock exclusivo no bloqueante sobre DATA_DIR/job.lock
+    (flock en posix, msvcrt en Windows/IIS); el id del job en curso se deja
+    en job.lock.id para devolverlo a quien llegue despues. El sistema libera
+    el lock si el proceso muere.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.path.join(DATA_DIR, "job.lock")
+        self._lock = threading.Lock()
+        self._fh = None
+        self.job_id = None
+
+    def _id_en_curso(self) -> str:
+        try:
+            with open(self.path + ".id", "r", encoding="utf-8") as f:
+                return f.read().strip() or "desconocido"
+        except OSError:
+            return "desconocido"
+
+    def acquire(self, job_id: str) -> str | None:
+        """None si el job puede arrancar; si no, el id del job que ya esta en marcha."""
+        if not self._lock.acquire(blocking=False):
+            return self.job_id or self._id_en_curso()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            fh = open(self.path, "a+")
+            if not bloquear_fichero(fh):
+                fh.close()
+                self._lock.release()
+                return self._id_en_curso()
+            with open(self.path + ".id", "w", encoding="utf-8") as f:
+                f.write(job_id)
+        except Exception:
+            self._lock.release()
+            raise
+        self._fh = fh
+        self.job_id = job_id
+        return None
+
+    def release(self) -> None:
+        fh, self._fh, self.job_id = self._fh, None, None
+        if fh is not None:
+            desbloquear_fichero(fh)
+            fh.close()
+        self._lock.release()
+
+job_lock = JobLock()
 
 # --------- job async ---------
-def job_enviar_async():
+JOB_ENGINE = os.getenv("APPJ1_ENGINE", "thread")  # thread | async | sharded
+JOB_ENGINES = ("thread", "async", "sharded")
+
+def job_enviar_async(engine: str | None = None, job_id: str | None = None):
+    # job_id: el job ya tiene job_lock (lo toma la ruta); sin el se toma aqui
+    if job_id is None:
+        job_id = uuid.uuid4().hex[:12]
+        en_curso = job_lock.acquire(job_id)
+        if en_curso:
+            log(f"job {job_id} no arranca: ya hay uno en marcha ({en_curso})", "warning")
+            return
+    engine = engine or JOB_ENGINE
+    job = jobs.start(job_id, engine)
+    error = None
     try:
-        with app.app_context():
-            rows = get_data_from_db()
-            if not rows:
-                log("no hay filas para enviar")
-                return
-            log(f"filas recuperadas: {len(rows)}")
-            send_email_batch(rows)
+        # la politica se compila una vez al empezar: consulta y filtro usan la misma
+        politica = politica_del_dia()
+        log(f"job {job_id} iniciado", dias=sorted(politica.dias, reverse=True), aviso_diario_menor_que=politica.menor_que)
+        if engine == "async":
+            asyncio.run(send_email_pipeline(politica=politica))
+            return
+        job.phase("querying")
+        if engine == "sharded":
+            # el reparto necesita todas las filas: sin cursor en streaming
+            with job.medir("query"):
+                rows = get_data_from_db(politica)
+            if rows is None:
+                raise DBReadError()
+            send_email_sharded(rows, politica)
+            return
+        if DB_STREAM:
+            send_email_batch(iter_data_from_db(politica), politica=politica)
+            return
+        with job.medir("query"):
+            rows = get_data_from_db(politica)
+        if rows is None:
+            raise DBReadError()
+        if not rows:
+            job.lectura_completa = True
+            log("no hay filas para enviar")
+            return
+        log(f"filas recuperadas: {len(rows)}", filas=len(rows), duracion_ms=round(job.tiempos.get("query", 0) * 1000))
+        send_email_batch(rows, politica=politica)
     except Exception as e:
-        log(f"job error: {e}")
+        error = str(e)
+        log(f"job error: {e}", "error")
+    finally:
+        log(f"job {job_id} terminado", duracion_ms=round((time.time() - job.inicio) * 1000))
+        jobs.finish(job, error)
+        job_lock.release()
 
 # --------- rutas ---------
 @app.route("/")
@@ -216,10 +3290,71 @@ def home():
 
 @app.route("/send_email", methods=["GET"])
 def send_email_route():
-    Thread(target=job_enviar_async, name="job_enviar_async_http", daemon=True).start()
-    return jsonify({"status": "accepted"}), 202
+    engine = request.args.get("engine") or JOB_ENGINE
+    if engine not in JOB_ENGINES:
+        return jsonify({"status": "error", "error": f"engine desconocido: {engine}"}), 400
+    job_id = uuid.uuid4().hex[:12]
+    en_curso = job_lock.acquire(job_id)
+    if en_curso:
+        return jsonify({"status": "running", "job_id": en_curso}), 200
+    try:
+        Thread(target=job_enviar_async, kwargs={"engine": engine, "job_id": job_id},
+               name="job_enviar_async_http", daemon=True).start()
+    except Exception:
+        job_lock.release()
+        raise
+    return jsonify({"status": "accepted", "engine": engine, "job_id": job_id}), 202
+
+@app.route("/jobs", methods=["GET"])
+def jobs_route():
+    return jsonify(jobs.snapshots())
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_route(job_id):
+    job = jobs.snapshot(job_id)
+    if job is None:
+        return jsonify({"status": "error", "error": f"job desconocido: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return metricas.exposicion(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/politica", methods=["GET"])
+def politica_route():
+    # pronostico: /politica?fecha=AAAA-MM-DD[&filas=1]
+    try:
+        fecha = datetime.strptime(request.args.get("fecha") or datetime.now().date().isoformat(), "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"status": "error", "error": "fecha debe ser AAAA-MM-DD"}), 400
+    try:
+        res = pronostico(fecha, filas=request.args.get("filas") == "1")
+    except Exception as e:
+        log(f"error en el pronostico: {e}", "error")
+        return jsonify({"status": "error", "error": str(e)}), 500
+    return jsonify({**res, "regla": regla_envio().to_dict()})
+
+@app.route("/cache", methods=["GET"])
+def cache_route():
+    return jsonify(query_cache.stats())
+
+@app.route("/cache/invalidate", methods=["POST"])
+def cache_invalidate_route():
+    query_cache.invalidate()
+    return jsonify({"status": "invalidated"})
 
 # --------- arranque ---------
+# las plantillas se compilan al cargar el modulo, no en el primer envio
+try:
+    log(f"plantillas precompiladas: {renderer.precompile()}")
+except Exception as e:
+    log(f"error precompilando plantillas: {e}", "error")
+
+# al importar (tambien bajo wfastcgi) se reanuda lo que quedo pendiente en el outbox
+# (no en los procesos de los shards: el drenado es cosa del proceso principal)
+if OUTBOX_ENABLED and multiprocessing.parent_process() is None:
+    outbox_drainer.start()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,359 @@
+"""Banco de pruebas offline de appj1: flota sintetica, consulta ITV simulada y Graph falso.
+
+Uso:
+    python bench_appj1.py                          # todos los escenarios
+    python bench_appj1.py -e serie -e batch        # solo algunos
+    python bench_appj1.py --vehiculos 50000 --latencia-ms 80 --p429 0.02
+
+Cada escenario corre en un proceso aparte (memoria pico y estado del modulo
+limpios) con su propio DATA_DIR temporal y un servidor Graph falso en
+127.0.0.1 que atiende token, sendMail y $batch. No toca MySQL ni Microsoft
+Graph. El resumen se imprime y se guarda en bench_output.txt.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource  # no existe en Windows
+except ImportError:
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --------- escenarios ---------
+# env: variables APPJ1_*/GRAPH_* del proceso hijo; envio: argumentos del motor
+# (engine: thread | async | sharded | outbox)
+# SIN_LIMITES fija explicitamente lo que mide la app sin limite por buzon; "defaults" usa la configuracion tal cual se despliega
+SIN_LIMITES = {"APPJ1_SENDER_PER_MINUTE": "0", "APPJ1_SENDER_CONCURRENCY": "64"}
+ESCENARIOS = {
+    "serie": {"env": SIN_LIMITES, "envio": {"workers": 1, "mode": "single", "digest": False}},
+    "paralelo": {"env": SIN_LIMITES, "envio": {"workers": 8, "mode": "single", "digest": False}},
+    "paralelo-32": {"env": {**SIN_LIMITES, "GRAPH_POOL_SIZE": "32"},
+                    "envio": {"workers": 32, "mode": "single", "digest": False}},
+    "batch": {"env": SIN_LIMITES, "envio": {"workers": 4, "mode": "batch", "digest": False}},
+    "digest": {"env": SIN_LIMITES, "envio": {"workers": 8, "mode": "single", "digest": True}},
+    "throttling": {"env": SIN_LIMITES, "envio": {"workers": 8, "mode": "single", "digest": False}, "p429": 0.05},
+    "async": {"env": {**SIN_LIMITES, "GRAPH_POOL_SIZE": "50"},
+              "envio": {"engine": "async", "concurrency": 50, "digest": False}},
+    "defaults": {"env": {}, "envio": {}},
+    "sharded": {"env": {**SIN_LIMITES, "APPJ1_SHARDS": "4", "APPJ1_SEND_WORKERS": "8"},
+                "envio": {"engine": "sharded"}},
+    "outbox": {"env": {**SIN_LIMITES, "APPJ1_OUTBOX": "1", "APPJ1_OUTBOX_WORKERS": "4"},
+               "envio": {"engine": "outbox", "workers": 1, "mode": "single", "digest": False}},
+}
+
+# --------- flota sintetica ---------
+CENTROS = ["Murcia", "Cartagena", "Lorca", "Alicante", "Elche", "Albacete", "Valencia", None]
+PESOS_CENTROS = [30, 18, 12, 12, 10, 8, 6, 4]  # unos pocos centros concentran la flota
+NOMBRES = ["Antonio", "Maria", "Jose", "Carmen", "Francisco", "Ana", "Juan", "Isabel", "Manuel", "Laura"]
+LETRAS = "BCDFGHJKLMNPRSTVWXYZ"
+
+def generar_flota(n: int, hoy: date, seed: int = 1) -> list:
+    """Vehiculos (matricula, fecha_itv, nombre, centro, email) con fechas de ITV realistas.
+
+    - la mayoria de las ITV caen repartidas en el proximo ano (inspeccion anual)
+    - un 30% llega en lotes de compra: varios vehiculos de un centro con la misma fecha
+    - un 4% esta caducado (hasta 90 dias), que es lo que genera el aviso diario
+    - un conductor puede llevar varios vehiculos (agrupados en el digest)
+    """
+    rng = random.Random(seed)
+    conductores = max(n * 10 // 13, 1)
+    flota = []
+    i = 0
+    while i < n:
+        centro = rng.choices(CENTROS, PESOS_CENTROS)[0]
+        r = rng.random()
+        if r < 0.04:
+            fechas = [hoy - timedelta(days=rng.randint(1, 90))]
+        elif r < 0.34:
+            # lote de compra: misma fecha para todo el lote
+            fechas = [hoy + timedelta(days=rng.randint(0, 364))] * rng.randint(5, 40)
+        else:
+            fechas = [hoy + timedelta(days=rng.randint(0, 364))]
+        for fecha in fechas[: n - i]:
+            # un 20% de los vehiculos se concentra en unos pocos conductores (jefes de equipo, comerciales)
+            c = min(int(rng.paretovariate(1.5)) - 1, 50) if rng.random() < 0.2 else rng.randrange(conductores)
+            c = c if c < conductores else rng.randrange(conductores)
+            matricula = f"{i % 10000:04d} {LETRAS[i // 10000 % 20]}{LETRAS[i // 400 % 20]}{LETRAS[i // 20 % 20]}"
+            flota.append((matricula, fecha, NOMBRES[c % len(NOMBRES)], centro, f"conductor{c}@flota.test"))
+            i += 1
+    return flota
+
+def consulta_itv(appj1, flota: list, politica: tuple, hoy: date) -> list:
+    """Sustituto de la consulta ITV: mismo filtro que el WHERE de itv_query sobre la flota."""
+    dias, menor_que = politica
+    if not dias and menor_que is None:
+        return []
+    filas = []
+    for matricula, fecha, nombre, centro, email in flota:
+        restantes = (fecha - hoy).days
+        if restantes >= appj1.VENTANA_DIAS:
+            continue
+        if restantes in dias or (menor_que is not None and restantes < menor_que):
+            filas.append(appj1.FilaITV(matricula, fecha.strftime("%d/%m/%Y"), nombre, centro, email, restantes))
+    return filas
+
+# --------- Graph falso ---------
+class GraphFalso(ThreadingHTTPServer):
+    """Token, sendMail y $batch con latencia log-normal y 429 inyectados."""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latencia_ms: float = 50.0, p429: float = 0.0, retry_after: float = 0.2, seed: int = 1):
+        super().__init__(("127.0.0.1", 0), _GraphHandler)
+        self.latencia = latencia_ms / 1000.0
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.cuenta = {"token": 0, "sendMail": 0, "batch": 0, "subpeticiones": 0, "aceptados": 0, "limitados": 0}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def espera(self) -> float:
+        # mediana = latencia configurada, cola larga como la de Graph
+        return self.latencia * self.rng.lognormvariate(0, 0.5) if self.latencia else 0.0
+
+    def limitar(self) -> bool:
+        return self.p429 > 0 and self.rng.random() < self.p429
+
+    def contar(self, **n) -> None:
+        with self._lock:
+            for k, v in n.items():
+                self.cuenta[k] += v
+
+    def arrancar(self) -> "GraphFalso":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class _GraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como el pool de httpx espera
+
+    def log_message(self, *args):
+        pass
+
+    def _responder(self, status: int, cuerpo=None, cabeceras: dict | None = None) -> None:
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+        self.send_response(status)
+        for k, v in (cabeceras or {}).items():
+            self.send_header(k, v)
+        if cuerpo is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def _limitado(self) -> dict:
+        return {"status": 429, "headers": {"Retry-After": f"{self.server.retry_after:g}"},
+                "body": {"error": {"code": "TooManyRequests", "message": "Graph falso: limitado"}}}
+
+    def do_POST(self):
+        srv = self.server
+        cuerpo = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.endswith("/oauth2/v2.0/token"):
+            srv.contar(token=1)
+            return self._responder(200, {"access_token": "falso", "token_type": "Bearer", "expires_in": 3600})
+        if self.path.endswith("/sendMail"):
+            time.sleep(srv.espera())
+            if srv.limitar():
+                srv.contar(sendMail=1, limitados=1)
+                sub = self._limitado()
+                return self._responder(429, sub["body"], sub["headers"])
+            srv.contar(sendMail=1, aceptados=1)
+            return self._responder(202)
+        if self.path.endswith("/$batch"):
+            peticiones = json.loads(cuerpo or b"{}").get("requests", [])
+            # Graph atiende los subrequests en paralelo: tarda lo que el mas lento
+            time.sleep(max((srv.espera() for _ in peticiones), default=0.0))
+            respuestas = []
+            for p in peticiones:
+                if srv.limitar():
+                    respuestas.append({"id": p.get("id"), **self._limitado()})
+                else:
+                    respuestas.append({"id": p.get("id"), "status": 202, "headers": {}, "body": None})
+            limitados = sum(1 for r in respuestas if r["status"] == 429)
+            srv.contar(batch=1, subpeticiones=len(peticiones), aceptados=len(peticiones) - limitados,
+                       limitados=limitados)
+            return self._responder(200, {"responses": respuestas})
+        self._responder(404, {"error": {"code": "NotFound", "message": self.path}})
+
+# --------- medidas ---------
+def percentil(valores: list, p: float) -> float | None:
+    if not valores:
+        return None
+    orden = sorted(valores)
+    return orden[min(int(round(p / 100.0 * (len(orden) - 1))), len(orden) - 1)]
+
+def rss_pico_mb() -> float | None:
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux da KiB y macOS bytes
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def primer_dia_de_envio(appj1, desde: date) -> date:
+    regla = appj1.regla_envio()
+    dia = desde
+    while not regla.envia(dia):
+        dia += timedelta(days=1)
+    return dia
+
+# --------- proceso hijo: un escenario ---------
+def ejecutar_escenario(nombre: str, args) -> dict:
+    esc = ESCENARIOS[nombre]
+    p429 = esc.get("p429", args.p429)
+    graph = GraphFalso(args.latencia_ms, p429, args.retry_after, args.seed).arrancar()
+    datos = tempfile.mkdtemp(prefix=f"bench_appj1_{nombre}_")
+    # el modulo lee la configuracion al importarse: todo antes del import
+    os.environ.update({
+        "GRAPH_TENANT_ID": "tenant-falso",
+        "GRAPH_CLIENT_ID": "cliente-falso",
+        "GRAPH_CLIENT_SECRET": "secreto-falso",
+        "GRAPH_BASE_URL": f"{graph.url}/v1.0",
+        "GRAPH_LOGIN_URL": graph.url,
+        "GRAPH_BACKOFF_BASE": "0.05",
+        "APPJ1_DATA_DIR": datos,
+        "APPJ1_LOG_FILE": os.path.join(datos, "appj1.log"),
+        "APPJ1_QUERY_CACHE_TTL": "0",
+        "APPJ1_OUTBOX": "0",
+        **esc["env"],
+    })
+    os.chdir(BASE_DIR)
+    sys.path.insert(0, BASE_DIR)
+    import appj1
+
+    hoy = primer_dia_de_envio(appj1, date.today())
+    politica = appj1.politica_del_dia(hoy)
+    flota = generar_flota(args.vehiculos, hoy, args.seed)
+    t0 = time.perf_counter()
+    filas = consulta_itv(appj1, flota, politica, hoy)
+    t_consulta = time.perf_counter() - t0
+    # el motor async y los jobs leen por get_data_from_db: se sirve la consulta simulada
+    appj1.get_data_from_db = lambda politica=None: list(filas)
+    appj1.iter_data_from_db = lambda politica=None: iter(filas)
+
+    # latencia de cada peticion a Graph (sync y async pasan por el histograma)
+    latencias = []
+    observar = appj1.M_GRAPH_SEGUNDOS.observe
+
+    def observar_y_guardar(valor, **etiquetas):
+        if etiquetas.get("endpoint") in ("sendMail", "batch"):
+            latencias.append(valor)
+        observar(valor, **etiquetas)
+
+    appj1.M_GRAPH_SEGUNDOS.observe = observar_y_guardar
+
+    envio = dict(esc["envio"])
+    motor = envio.pop("engine", "thread")
+    t0 = time.perf_counter()
+    if motor == "async":
+        import asyncio
+        res = asyncio.run(appj1.send_email_pipeline(politica=politica, **envio))
+        enviados = res["enviados"]
+    elif motor == "sharded":
+        # los shards son procesos spawn: heredan el env pero su latencia no pasa por este histograma
+        enviados = appj1.send_email_sharded(filas, politica)["enviados"]
+    elif motor == "outbox":
+        # send_email_batch solo encola; el tiempo cuenta hasta que los drain workers vacian la cola
+        appj1.send_email_batch(filas, politica=politica, **envio)
+        while (estado := appj1.outbox.stats()).get("pendiente") or estado.get("enviando"):
+            time.sleep(0.05)
+        enviados = estado.get("enviado", 0)
+    else:
+        enviados = appj1.send_email_batch(filas, politica=politica, **envio)
+    segundos = time.perf_counter() - t0
+    appj1.log_escritor.stop()
+    graph.shutdown()
+    shutil.rmtree(datos, ignore_errors=True)  # ledger y log del escenario
+
+    cuenta = dict(graph.cuenta)
+    return {
+        "escenario": nombre,
+        "vehiculos": len(flota),
+        "filas": len(filas),
+        "enviados": enviados,
+        "mensajes": cuenta["aceptados"],
+        "limitados": cuenta["limitados"],
+        "peticiones": cuenta["sendMail"] + cuenta["batch"],
+        "consulta_ms": round(t_consulta * 1000, 1),
+        "segundos": round(segundos, 3),
+        "filas_s": round(len(filas) / segundos, 1) if segundos else None,
+        "mensajes_s": round(cuenta["aceptados"] / segundos, 1) if segundos else None,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 1) if latencias else None,
+        "p99_ms": round(percentil(latencias, 99) * 1000, 1) if latencias else None,
+        "rss_pico_mb": rss_pico_mb(),
+        "latencia_ms": args.latencia_ms,
+        "p429": p429,
+    }
+
+# --------- informe ---------
+COLUMNAS = [
+    ("escenario", "escenario", 12), ("filas", "filas", 7), ("mensajes", "msgs", 7), ("limitados", "429", 5),
+    ("segundos", "seg", 8), ("filas_s", "filas/s", 9), ("mensajes_s", "msgs/s", 9),
+    ("p50_ms", "p50 ms", 8), ("p99_ms", "p99 ms", 8), ("rss_pico_mb", "RSS MB", 8),
+]
+
+def tabla(resultados: list) -> str:
+    lineas = ["".join(f"{titulo:>{ancho}}" for _, titulo, ancho in COLUMNAS)]
+    for r in resultados:
+        if "error" in r:
+            lineas.append(f"{r['escenario']:>12}  error: {r['error']}")
+            continue
+        lineas.append("".join(f"{'-' if r[k] is None else r[k]!s:>{ancho}}" for k, _, ancho in COLUMNAS))
+    return "\n".join(lineas)
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Benchmark offline de appj1 (sin MySQL ni Graph reales)")
+    ap.add_argument("-e", "--escenario", action="append", choices=sorted(ESCENARIOS),
+                    help="escenario a medir (repetible); por defecto todos")
+    ap.add_argument("--vehiculos", type=int, default=20000, help="tamano de la flota sintetica")
+    ap.add_argument("--latencia-ms", type=float, default=50.0, help="mediana de latencia del Graph falso")
+    ap.add_argument("--p429", type=float, default=0.0, help="probabilidad de 429 por mensaje")
+    ap.add_argument("--retry-after", type=float, default=0.2, help="Retry-After de los 429 (segundos)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--salida", default=os.path.join(BASE_DIR, "bench_output.txt"),
+                    help="fichero del informe (vacio: solo pantalla)")
+    ap.add_argument("--json", action="store_true", help="imprime los resultados en JSON")
+    ap.add_argument("--hijo", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.hijo:
+        print(json.dumps(ejecutar_escenario(args.hijo, args)))
+        return 0
+
+    comun = ["--vehiculos", str(args.vehiculos), "--latencia-ms", str(args.latencia_ms), "--p429", str(args.p429),
+             "--retry-after", str(args.retry_after), "--seed", str(args.seed)]
+    resultados = []
+    for nombre in args.escenario or list(ESCENARIOS):
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), "--hijo", nombre, *comun],
+                           capture_output=True, text=True)
+        try:
+            resultados.append(json.loads(p.stdout.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            error = (p.stderr.strip().splitlines() or ["sin salida"])[-1]
+            resultados.append({"escenario": nombre, "error": error})
+        print(f"{nombre}: {'error' if 'error' in resultados[-1] else 'ok'}", file=sys.stderr)
+
+    informe = json.dumps(resultados, indent=2) if args.json else tabla(resultados)
+    print(informe)
+    if args.salida:
+        cabecera = (f"# appj1 bench {time.strftime('%Y-%m-%d %H:%M:%S')} vehiculos={args.vehiculos} "
+                    f"latencia_ms={args.latencia_ms:g} p429={args.p429:g} retry_after={args.retry_after:g}\n")
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(cabecera + informe + "\n")
+    return 1 if any("error" in r for r in resultados) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
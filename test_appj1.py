@@ -0,0 +1,315 @@
+"""Pruebas de regresion de appj1: politica, consulta ITV, cache, ledger, jobs, outbox y $batch.
+
+    python -m pytest -q test_appj1.py
+
+No hace falta MySQL ni Graph: el envio se sustituye por una funcion que
+solo anota los payloads.
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import date, timedelta
+
+# appj1 lee la configuracion al importarse
+os.environ.setdefault("GRAPH_TENANT_ID", "tenant-prueba")
+os.environ.setdefault("GRAPH_CLIENT_ID", "cliente-prueba")
+os.environ.setdefault("GRAPH_CLIENT_SECRET", "secreto-prueba")
+os.environ.setdefault("APPJ1_DATA_DIR", tempfile.mkdtemp(prefix="appj1_test_"))
+os.environ.setdefault("APPJ1_LOG_FILE", os.path.join(os.environ["APPJ1_DATA_DIR"], "appj1.log"))
+os.environ.setdefault("APPJ1_LOG_LEVEL", "WARNING")
+os.environ.setdefault("APPJ1_SENDER_PER_MINUTE", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+import pytest
+
+import appj1
+
+# --------- politica ---------
+UMBRALES_ANTERIORES = (31, 25, 20, 15)
+DIARIO_ANTERIOR = 13
+
+def politica_anterior(fecha: date) -> tuple:
+    # la regla fija de antes de config.json: domingo sin envio, el lunes recupera los umbrales del domingo
+    if fecha.weekday() == 6:
+        return frozenset(), None
+    dias = set(UMBRALES_ANTERIORES)
+    if (fecha - timedelta(days=1)).weekday() == 6:
+        dias |= {d - 1 for d in UMBRALES_ANTERIORES}
+    return frozenset(dias), DIARIO_ANTERIOR
+
+def test_compilar_equivale_a_la_regla_anterior():
+    regla = appj1.ReglaEnvio()
+    inicio = date(2026, 1, 1)
+    for n in range(60):
+        fecha = inicio + timedelta(days=n)
+        nueva, anterior = regla.compilar(fecha), politica_anterior(fecha)
+        for dias_restantes in range(-20, 120):
+            assert appj1.debe_enviar(dias_restantes, nueva) == appj1.debe_enviar(dias_restantes, anterior), \
+                (fecha, dias_restantes)
+
+def test_festivo_en_lunes_recupera_domingo_y_lunes_el_martes():
+    regla = appj1.ReglaEnvio({"festivos": ["2026-10-12"]})  # lunes
+    assert not regla.envia(date(2026, 10, 12))
+    dias, menor_que = regla.compilar(date(2026, 10, 13))
+    assert menor_que == 13
+    assert {31, 30, 29, 25, 24, 23, 20, 19, 18, 15, 14} <= dias
+    assert regla.compilar(date(2026, 10, 12)) == appj1.PoliticaDia(frozenset(), None)
+
+def test_sin_recuperar_el_lunes_solo_lleva_sus_umbrales():
+    regla = appj1.ReglaEnvio({"recuperar": False})
+    assert regla.compilar(date(2026, 10, 19)).dias == frozenset({31, 25, 20, 15})
+
+def test_umbrales_fuera_de_la_ventana_se_ignoran():
+    regla = appj1.ReglaEnvio({"umbrales": [40, 20, -1]})
+    assert regla.umbrales == (20,)
+
+# --------- consulta ITV ---------
+def _marcadores(sql: str) -> int:
+    # %% es un % literal (DATE_FORMAT); solo cuentan los %s
+    return len(re.findall(r"%s", sql.replace("%%", "")))
+
+def test_itv_query_sin_fecha_usa_curdate():
+    politica = appj1.PoliticaDia(frozenset({31, 25, 20, 15}), 13)
+    sql, params = appj1.itv_query(politica)
+    assert "CURDATE()" in sql
+    assert params == [appj1.VENTANA_DIAS, 13, 15, 20, 25, 31]
+    assert _marcadores(sql) == len(params)
+
+def test_itv_query_con_fecha_repite_la_fecha_en_su_sitio():
+    politica = appj1.PoliticaDia(frozenset({20, 15}), 13)
+    sql, params = appj1.itv_query(politica, date(2026, 10, 19))
+    f = "2026-10-19"
+    assert "CURDATE()" not in sql
+    # DATEDIFF del SELECT, limite de la ventana, aviso diario y valores exactos, en el orden del SQL
+    assert params == [f, f, appj1.VENTANA_DIAS, f, 13, f, 15, 20]
+    assert _marcadores(sql) == len(params)
+
+def test_itv_query_solo_valores_exactos():
+    sql, params = appj1.itv_query(appj1.PoliticaDia(frozenset({31}), None))
+    assert params == [appj1.VENTANA_DIAS, 31]
+    assert _marcadores(sql) == len(params)
+
+def test_itv_query_dia_sin_envio():
+    assert appj1.itv_query(appj1.PoliticaDia(frozenset(), None)) == (None, None)
+
+# --------- cache de la consulta ---------
+def test_cache_borra_del_disco_las_fotos_de_otros_dias(tmp_path):
+    viejo = tmp_path / "consulta_2020-01-01_0123456789abcdef.json"
+    viejo.write_text("{}")
+    cache = appj1.QueryCache(ttl=60, disk_dir=str(tmp_path))
+    filas = _filas(2)
+    cache.put("SELECT 1", [], filas)
+    assert not viejo.exists()
+    assert [p.name.startswith("consulta_") for p in tmp_path.iterdir()] == [True]
+    assert cache.get("SELECT 1", []) == filas
+
+# --------- ledger ---------
+@pytest.fixture
+def envio_falso(monkeypatch, tmp_path):
+    enviados = []
+    monkeypatch.setattr(appj1, "ledger", appj1.SentLedger(str(tmp_path / "envios.db")))
+    monkeypatch.setattr(appj1, "graph_sendmail", lambda payload, ctl=None: enviados.append(payload))
+    monkeypatch.setattr(appj1, "OUTBOX_ENABLED", False)
+    return enviados
+
+def _filas(n: int, dias_restantes: int = 5) -> list:
+    return [appj1.FilaITV(f"{i:04d} BCD", "01/01/2027", "Ana", "Murcia", f"conductor{i}@flota.test", dias_restantes)
+            for i in range(n)]
+
+def test_ledger_omite_lo_enviado_al_repetir(envio_falso):
+    politica = appj1.PoliticaDia(frozenset(), 13)
+    filas = _filas(5)
+    assert appj1.send_email_batch(filas, workers=1, mode="single", digest=False, politica=politica) == 5
+    res, _ = appj1._send_email_batch(filas, workers=1, mode="single", digest=False, politica=politica)
+    assert res["enviados"] == 0
+    assert res["omitidos"] == 5
+    assert len(envio_falso) == 5
+
+def test_ledger_reenvia_si_cambia_el_umbral(envio_falso):
+    politica = appj1.PoliticaDia(frozenset(), 13)
+    appj1.send_email_batch(_filas(3, 5), workers=1, mode="single", digest=False, politica=politica)
+    # mismo vehiculo y destinatario con otros dias restantes: es otro aviso
+    assert appj1.send_email_batch(_filas(3, 4), workers=1, mode="single", digest=False, politica=politica) == 3
+    assert len(envio_falso) == 6
+
+def test_ledger_solo_registra_lo_enviado(envio_falso, monkeypatch):
+    politica = appj1.PoliticaDia(frozenset(), 13)
+    filas = _filas(4)
+
+    def falla_uno(payload, ctl=None):
+        if payload["message"]["toRecipients"][0]["emailAddress"]["address"] == filas[2].email:
+            raise RuntimeError("rechazado")
+        envio_falso.append(payload)
+
+    monkeypatch.setattr(appj1, "graph_sendmail", falla_uno)
+    assert appj1.send_email_batch(filas, workers=1, mode="single", digest=False, politica=politica) == 3
+    monkeypatch.setattr(appj1, "graph_sendmail", lambda payload, ctl=None: envio_falso.append(payload))
+    res, _ = appj1._send_email_batch(filas, workers=1, mode="single", digest=False, politica=politica)
+    assert (res["enviados"], res["omitidos"]) == (1, 3)
+
+# --------- jobs ---------
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_job_falla_si_la_consulta_falla(engine, monkeypatch):
+    # get_data_from_db devuelve None si MySQL falla: no es "sin filas"
+    monkeypatch.setattr(appj1, "get_data_from_db", lambda politica=None: None)
+    monkeypatch.setattr(appj1, "DB_STREAM", False)
+    job_id = f"prueba-{engine}"
+    assert appj1.job_lock.acquire(job_id) is None
+    appj1.job_enviar_async(engine, job_id)
+    estado = appj1.jobs.snapshot(job_id)
+    assert estado["phase"] == "error"
+    assert estado["error"] == str(appj1.DBReadError())
+
+# --------- outbox ---------
+def _encolar(box, filas, fecha="2026-10-19"):
+    return box.enqueue([([row], {"message": {"subject": row.matricula}}) for row in filas], fecha)
+
+def _estados(box) -> dict:
+    with box._lock:
+        return {id_: (estado, intentos) for id_, estado, intentos in
+                box._conexion().execute("SELECT id, estado, intentos FROM outbox")}
+
+def test_outbox_no_encola_dos_veces_el_mismo_aviso(tmp_path):
+    box = appj1.Outbox(str(tmp_path / "outbox.db"))
+    assert _encolar(box, _filas(3)) == 3
+    assert _encolar(box, _filas(3)) == 0
+    assert box.stats() == {"pendiente": 3}
+
+def test_outbox_reclamo_vivo_no_se_recupera(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    box, otro = appj1.Outbox(path), appj1.Outbox(path)
+    _encolar(box, _filas(3))
+    assert len(box.claim(2)) == 2
+    # otro proceso no ve lo reclamado ni se lo quita mientras dura el lease
+    assert [f[0] for f in otro.claim(5)] == [3]
+    assert otro.recover() == 0
+    assert otro.claim(5) == []
+    assert box.stats() == {"enviando": 3}
+
+def test_outbox_reclamo_caducado_vuelve_a_pendiente(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    box = appj1.Outbox(path)
+    _encolar(box, _filas(2))
+    box.claim(2)
+    # el proceso que reclamo murio: pasado el lease otro lo recupera y lo vuelve a reclamar
+    otro = appj1.Outbox(path, lease=0)
+    assert otro.recover() == 2
+    assert len(otro.claim(5)) == 2
+
+def test_outbox_drain_entrega_reintenta_y_descarta(tmp_path, monkeypatch):
+    box = appj1.Outbox(str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(appj1, "ledger", appj1.SentLedger(str(tmp_path / "envios.db")))
+    filas = _filas(4)
+    _encolar(box, filas)
+    errores = [None, appj1.GraphBatchError(400, "mal"), appj1.GraphBatchError(503, "ocupado"),
+               appj1.CircuitOpenError()]
+    monkeypatch.setattr(appj1, "send_mail_graph_batch", lambda payloads, ctl=None: errores[:len(payloads)])
+    appj1.OutboxDrainer(box).drain(box.claim(10), appj1.DeliveryController())
+    # enviado, 400 a dead-letter, 503 reintenta gastando intento, circuito abierto sin gastarlo
+    assert _estados(box) == {1: ("enviado", 0), 2: ("muerto", 1), 3: ("pendiente", 1), 4: ("pendiente", 0)}
+    assert appj1.ledger.enviados("2026-10-19") == {appj1.SentLedger.clave(filas[0])}
+
+def test_outbox_descarta_al_agotar_intentos(tmp_path, monkeypatch):
+    box = appj1.Outbox(str(tmp_path / "outbox.db"))
+    _encolar(box, _filas(1))
+    monkeypatch.setattr(appj1, "send_mail_graph_batch",
+                        lambda payloads, ctl=None: [appj1.GraphBatchError(503, "ocupado")] * len(payloads))
+    drainer = appj1.OutboxDrainer(box)
+    for _ in range(appj1.OUTBOX_MAX_ATTEMPTS):
+        with box._lock:
+            box._conexion().execute("UPDATE outbox SET proximo = 0")
+        drainer.drain(box.claim(10), appj1.DeliveryController())
+    assert _estados(box) == {1: ("muerto", appj1.OUTBOX_MAX_ATTEMPTS)}
+
+def test_outbox_el_resumen_los_da_por_encolados(tmp_path, monkeypatch, envio_falso):
+    monkeypatch.setattr(appj1, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(appj1, "outbox", appj1.Outbox(str(tmp_path / "outbox.db")))
+    politica = appj1.PoliticaDia(frozenset(), 13)
+    res, resultados = appj1._send_email_batch(_filas(3), workers=1, mode="single", digest=False,
+                                              politica=politica, resumen=False)
+    assert (res["enviados"], res["encolados"]) == (0, 3)
+    assert {enviado for _, enviado in resultados} == {appj1.ENCOLADO}
+    assert envio_falso == []
+
+# --------- $batch ---------
+class _SinEspera(appj1.DeliveryController):
+    # los reintentos no duermen en las pruebas
+    def wait(self, intento: int, retry_after: float = 0.0) -> None:
+        self._espera(intento, retry_after)
+
+class _RespuestaBatch:
+    def __init__(self, responses):
+        self._responses = responses
+
+    def json(self):
+        return {"responses": self._responses}
+
+@pytest.fixture
+def graph_batch_falso(monkeypatch, tmp_path):
+    """graph_post falso: cada llamada aplica la siguiente funcion de la lista a los ids del sobre."""
+    monkeypatch.setattr(appj1, "remitentes", appj1.SenderPool(["a@flota.test"], per_minute=0, path=str(tmp_path / "r.db")))
+    sobres, respuestas = [], []
+
+    def graph_post(url, body, ctl=None, shift_throttle=False):
+        ids = [x["id"] for x in body["requests"]]
+        sobres.append(ids)
+        respuesta = respuestas.pop(0)
+        if isinstance(respuesta, Exception):
+            raise respuesta
+        return _RespuestaBatch([r for i in ids if (r := respuesta(i)) is not None])
+
+    monkeypatch.setattr(appj1, "graph_post", graph_post)
+    return sobres, respuestas
+
+def _sin_pendientes() -> bool:
+    return all(r.pendientes == 0 and r.en_vuelo == 0 for r in appj1.remitentes._remitentes)
+
+def _payloads(n: int) -> list:
+    return [{"message": {"toRecipients": [{"emailAddress": {"address": f"c{i}@flota.test"}}]}} for i in range(n)]
+
+def test_batch_solo_reintenta_los_subrequests_transitorios(graph_batch_falso):
+    sobres, respuestas = graph_batch_falso
+    estados = {"0": 202, "1": 400, "2": 503, "3": 500}
+    respuestas.append(lambda i: {"id": i, "status": estados[i], "body": {"error": {"message": f"e{i}"}}})
+    respuestas.append(lambda i: {"id": i, "status": 202})
+    resultados = appj1.send_mail_graph_batch(_payloads(4), _SinEspera())
+    assert sobres == [["0", "1", "2", "3"], ["2", "3"]]
+    assert resultados[0] is None and resultados[2] is None and resultados[3] is None
+    assert isinstance(resultados[1], appj1.GraphBatchError) and resultados[1].status == 400
+    assert appj1.remitentes.stats()["a@flota.test"]["mensajes_hoy"] == 3
+    assert _sin_pendientes()
+
+def test_batch_reintenta_si_falta_la_respuesta(graph_batch_falso):
+    sobres, respuestas = graph_batch_falso
+    respuestas.append(lambda i: None if i == "1" else {"id": i, "status": 202})
+    respuestas.append(lambda i: {"id": i, "status": 202})
+    assert appj1.send_mail_graph_batch(_payloads(2), _SinEspera()) == [None, None]
+    assert sobres == [["0", "1"], ["1"]]
+    assert _sin_pendientes()
+
+def test_batch_sobre_rechazado_no_se_reintenta(graph_batch_falso):
+    sobres, respuestas = graph_batch_falso
+    peticion = httpx.Request("POST", "https://graph.test/$batch")
+    respuestas.append(httpx.HTTPStatusError("400", request=peticion, response=httpx.Response(400, request=peticion)))
+    resultados = appj1.send_mail_graph_batch(_payloads(3), _SinEspera())
+    assert sobres == [["0", "1", "2"]]
+    assert all(isinstance(e, httpx.HTTPStatusError) for e in resultados)
+    assert _sin_pendientes()
+
+def test_batch_sobre_sin_conexion_se_reintenta(graph_batch_falso):
+    sobres, respuestas = graph_batch_falso
+    respuestas.append(httpx.ConnectError("sin red"))
+    respuestas.append(lambda i: {"id": i, "status": 202})
+    assert appj1.send_mail_graph_batch(_payloads(2), _SinEspera()) == [None, None]
+    assert sobres == [["0", "1"], ["0", "1"]]
+    assert _sin_pendientes()
+
+def test_batch_circuito_abierto_libera_los_remitentes(graph_batch_falso):
+    sobres, respuestas = graph_batch_falso
+    respuestas.append(appj1.CircuitOpenError())
+    resultados = appj1.send_mail_graph_batch(_payloads(25), _SinEspera())
+    assert len(sobres) == 1
+    assert all(isinstance(e, appj1.CircuitOpenError) for e in resultados)
+    assert _sin_pendientes()